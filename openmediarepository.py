@@ -10,6 +10,7 @@
        >>> import io
        >>> import hashlib
        >>> import os
+       >>> import json
 
 
    ## Basic Data Structures
@@ -128,6 +129,14 @@
        >>> l
        ['6f847d12', '9d71ca42', 'aac73176']
 
+   Item counts per format, rights, creator and year of date are kept up
+   to date on adding.
+
+       >>> repository.facet_counts()["format"]
+       {'image/svg': 1}
+       >>> sorted(repository.facet_counts()["creator"].items())
+       [('alice@some.domain', 1), ('bob@some.domain', 1), ('eve@some.domain', 1)]
+
 
   The repository can be dumped for later reconstruction.
 
@@ -181,6 +190,8 @@
        >>> repository.items
        {}
        >>> repository.load()
+       >>> repository.facet_counts()["format"]
+       {'image/svg': 1}
        >>> identifiers = list(repository.items.keys())
        >>> identifiers.sort()
        >>> print_items(identifiers)
@@ -213,6 +224,198 @@
            title:
 
 
+   Files are written to a temporary file first and then renamed into
+   place, so a crash while writing leaves the previous version.
+
+       >>> omr.write_file_atomically("atomic.txt", "First")
+       >>> omr.write_file_atomically("atomic.txt", "Second")
+       >>> with open("atomic.txt", "rt", encoding="utf8") as fp:
+       ...     fp.read()
+       'Second'
+       >>> [name for name in os.listdir() if name.startswith("atomic.txt.")]
+       []
+       >>> os.remove("atomic.txt")
+
+   A SnapshotWriter dumps a repository in a background thread. Requests
+   made while a dump is being written are coalesced into one further
+   dump, and failed dumps are retried.
+
+       >>> import time
+       >>> class SlowRepository(omr.Repository):
+       ...     dumps = 0
+       ...     failing = False
+       ...     def dump(self):
+       ...         time.sleep(0.1)
+       ...         if self.failing:
+       ...             self.failing = False
+       ...             raise OSError("Disk full")
+       ...         self.dumps += 1
+       >>> snapshot_writer = omr.SnapshotWriter(SlowRepository(), retry_interval=0.1)
+       >>> snapshot_writer.start()
+       >>> for number in range(10):
+       ...     snapshot_writer.request()
+       >>> snapshot_writer.flush(timeout=10)
+       True
+       >>> snapshot_writer.written
+       10
+       >>> snapshot_writer.repository.dumps < 10
+       True
+       >>> snapshot_writer.repository.failing = True
+       >>> snapshot_writer.request()
+       >>> snapshot_writer.flush(timeout=10)
+       True
+       >>> snapshot_writer.written
+       11
+       >>> snapshot_writer.last_snapshot == omr.METRICS["snapshot_last_success"]
+       True
+       >>> snapshot_writer.stop()
+
+   Server processes share a read-only, memory-mapped snapshot of the
+   repository instead of each holding their own copy.
+
+       >>> omr.write_snapshot(repository.items)
+       >>> snapshot_items = omr.SnapshotItems()
+       >>> len(snapshot_items)
+       3
+       >>> sorted(snapshot_items) == identifiers
+       True
+       >>> snapshot_items[identifiers[0]].creator
+       'bob@some.domain'
+
+   Each process adds through its own SharedRepository. Changes are
+   numbered once for all processes, and readable in all of them as soon
+   as they are recorded, even if the adding process never dumps.
+
+       >>> import multiprocessing
+       >>> lock = multiprocessing.Lock()
+       >>> generation = multiprocessing.Value("Q", 0, lock=False)
+       >>> snapshot_lock = multiprocessing.Lock()
+       >>> worker_a = omr.SharedRepository(lock, generation, snapshot_lock)
+       >>> worker_a.load()
+       >>> worker_b = omr.SharedRepository(lock, generation, snapshot_lock)
+       >>> worker_b.load()
+       >>> worker_a.sequence()
+       3
+       >>> worker_a.add({"identifier": "added-by-a", "title": "Never dumped"})
+       >>> worker_b.add({"identifier": "added-by-b", "title": "Dumped"})
+       >>> worker_b.dump()
+       >>> worker_c = omr.SharedRepository(lock, generation, snapshot_lock)
+       >>> worker_c.load()
+       >>> worker_b.sequence(), worker_c.sequence()
+       (5, 5)
+       >>> worker_c.changes_since(3)
+       [(4, 'added-by-a'), (5, 'added-by-b')]
+       >>> worker_c.items["added-by-a"].title
+       'Never dumped'
+       >>> repository.dump()
+
+
+   ## Stored Media
+
+   Media files are stored under their identifier.
+
+       >>> media = omr.MediaStore()
+       >>> identifier = media.store(io.BytesIO(bytes("<svg><!-- Test 3 --></svg>", encoding="utf8")))
+       >>> identifier == test_item_supplied_class.identifier
+       True
+
+   A scrubber re-verifies stored content against the identifiers in
+   the background.
+
+       >>> omr.Scrubber(media).verify(identifier)
+       True
+
+   Previews of stored media are made on first request, and cached
+   within a size budget. Concurrent requests for the same preview wait
+   for one result.
+
+       >>> import shutil, threading
+       >>> text_media = omr.MediaStore("text_media")
+       >>> text_identifiers = [text_media.store(io.BytesIO(bytes("Text {0} ".format(number) * 1000, encoding="utf8"))) for number in range(2)]
+       >>> derivatives = omr.DerivativeCache(text_media, "derivatives", budget=3000)
+       >>> excerpt_filename = derivatives.get(text_identifiers[0], "text/plain")
+       >>> os.path.getsize(excerpt_filename) == omr.EXCERPT_LENGTH
+       True
+       >>> derivatives.get(text_identifiers[0], "text/plain") == excerpt_filename
+       True
+       >>> misses = omr.METRICS["derivative_misses"]
+       >>> results = []
+       >>> threads = [threading.Thread(target=lambda: results.append(derivatives.get(text_identifiers[1], "text/plain"))) for number in range(8)]
+       >>> for thread in threads:
+       ...     thread.start()
+       >>> for thread in threads:
+       ...     thread.join()
+       >>> len(set(results)), omr.METRICS["derivative_misses"] - misses
+       (1, 1)
+
+   The least recently used preview was evicted to fit the budget.
+
+       >>> os.path.exists(excerpt_filename), os.path.exists(results[0]), derivatives.size <= derivatives.budget
+       (False, True, True)
+       >>> shutil.rmtree(derivatives.path)
+       >>> shutil.rmtree(text_media.path)
+
+   Items, accounts and stored media are moved between hosts as a
+   streamed tar archive. Importing skips what is already present, so an
+   interrupted import is resumed by running it again.
+
+       >>> archive = io.BytesIO()
+       >>> omr.export_archive(archive, repository, media)
+       3
+       >>> imported_repository = omr.Repository()
+       >>> imported_media = omr.MediaStore("imported_media")
+       >>> report = omr.import_archive(io.BytesIO(archive.getvalue()), imported_repository, imported_media)
+       >>> report["items_added"], report["media_stored"], report["media_corrupt"]
+       (3, 1, 0)
+       >>> report = omr.import_archive(io.BytesIO(archive.getvalue()), imported_repository, imported_media)
+       >>> report["items_added"], report["items_present"], report["media_present"]
+       (0, 3, 1)
+       >>> os.remove(imported_media.filename(identifier))
+       >>> os.rmdir(os.path.dirname(imported_media.filename(identifier)))
+       >>> os.rmdir(imported_media.path)
+       >>> os.remove(media.filename(identifier))
+       >>> os.rmdir(os.path.dirname(media.filename(identifier)))
+       >>> os.rmdir(media.path)
+
+   Alternatively, files are split into content-defined chunks, and
+   near-duplicates share most of them. Identifiers do not change.
+
+       >>> import random, shutil
+       >>> chunked_media = omr.ChunkedMediaStore("chunked_media")
+       >>> content = random.Random(1).randbytes(600000)
+       >>> identifier = chunked_media.store(io.BytesIO(content))
+       >>> identifier == hashlib.new("whirlpool", content).hexdigest()
+       True
+       >>> edited_identifier = chunked_media.store(io.BytesIO(content[:300000] + b"edit" + content[300000:]))
+       >>> chunked_media.open(edited_identifier).read() == content[:300000] + b"edit" + content[300000:]
+       True
+       >>> chunked_media.statistics()["dedup_ratio"] > 1.5
+       True
+
+   Storing a file again does not count it twice.
+
+       >>> dedup_ratio = chunked_media.statistics()["dedup_ratio"]
+       >>> chunked_media.store(io.BytesIO(content)) == identifier
+       True
+       >>> chunked_media.statistics()["dedup_ratio"] == dedup_ratio
+       True
+       >>> omr.ChunkedMediaStore("chunked_media").statistics()["dedup_ratio"] == dedup_ratio
+       True
+
+   Chunked media are exported whole.
+
+       >>> import tarfile
+       >>> chunked_repository = omr.Repository()
+       >>> chunked_repository.add({"identifier": identifier, "title": "Chunked"})
+       >>> archive = io.BytesIO()
+       >>> omr.export_archive(archive, chunked_repository, chunked_media)
+       1
+       >>> tarfile.open(fileobj=io.BytesIO(archive.getvalue())).extractfile("media/" + identifier).read() == content
+       True
+       >>> chunked_media.stop()
+       >>> shutil.rmtree(chunked_media.path)
+
+
    ## HTTP API
 
    Fist make sure to start from scratch for the examples.
@@ -248,6 +451,42 @@
        >>> html_response.index("identifier already exists") > -1
        True
 
+   ### Add many items
+
+   URI: /items/batch
+   Method: POST
+
+   The request body is a JSON list of items, or one item per line
+   (NDJSON). Each item is reported as added, duplicate or invalid, and
+   the whole batch is persisted once.
+
+       >>> cherrypy.serving.request.method = "POST"
+       >>> requested = webapp.snapshots.requested
+       >>> batch_identifiers = [hashlib.new("whirlpool", bytes("Batch {0}".format(number), encoding="utf8")).hexdigest() for number in range(3)]
+       >>> ndjson = "\\n".join([json.dumps({"identifier": identifier, "title": "Batch"}) for identifier in batch_identifiers[:2]])
+       >>> ndjson += "\\n" + json.dumps(test_item_dict) + "\\n" + json.dumps({"identifier": "not valid"})
+       >>> batch_response = json.loads(webapp.items.batch(ndjson).decode("utf8"))
+       >>> batch_response["added"], batch_response["duplicate"], batch_response["invalid"]
+       (2, 1, 1)
+       >>> [result["result"] for result in batch_response["results"]]
+       ['added', 'added', 'duplicate', 'invalid']
+       >>> webapp.snapshots.requested - requested
+       1
+
+   Items repeated within a batch are duplicates as well.
+
+       >>> batch_response = json.loads(webapp.items.batch(json.dumps([{"identifier": batch_identifiers[2], "title": "Batch"}] * 2)).decode("utf8"))
+       >>> [result["result"] for result in batch_response["results"]]
+       ['added', 'duplicate']
+
+   Batches are limited to BATCH_LIMIT items.
+
+       >>> webapp.items.batch(json.dumps([{}] * (omr.BATCH_LIMIT + 1)))
+       Traceback (most recent call last):
+       ...
+       cherrypy._cperror.HTTPError: (413, 'At most 10000 items per batch')
+       >>> cherrypy.serving.request.method = "GET"
+
    ### Display multiple items
 
    URI: /items
@@ -257,6 +496,35 @@
        >>> html_response.index("<ul>") > -1
        True
 
+   ### Follow changes
+
+   URI: /changes?since=N[&timeout=seconds][&limit=N]
+   Method: GET
+
+   Every added item gets a sequence number. Followers poll the feed,
+   optionally blocking for timeout seconds until there are changes.
+
+       >>> feed = json.loads(webapp.changes(since="0").decode("utf8"))
+       >>> feed["sequence"]
+       4
+       >>> [change["item"]["title"] for change in feed["changes"]]
+       ['Test 1 SVG image', 'Batch', 'Batch', 'Batch']
+       >>> json.loads(webapp.changes(since="4").decode("utf8"))["changes"]
+       []
+
+   ### Mirror items
+
+   URI: /items/sync?token=...[&limit=N]
+   Method: GET
+
+   Mirrors fetch only the items added since their last sync token.
+
+       >>> sync = json.loads(webapp.items.sync().decode("utf8"))
+       >>> [item["title"] for item in sync["items"]], sync["more"], sync["reset"]
+       (['Test 1 SVG image', 'Batch', 'Batch', 'Batch'], False, False)
+       >>> json.loads(webapp.items.sync(token=sync["token"]).decode("utf8"))["items"]
+       []
+
    ### Display a single item
 
    URI: /items/(identifier)
@@ -266,11 +534,70 @@
        >>> html_response.index("<ul>") > -1
        True
 
+   ### Admission control
+
+   Requests are sorted into route classes, each with its own limit of
+   concurrent requests. A request that gets no slot is answered with
+   503 and a Retry-After header right away.
+
+       >>> omr.route_class("/items", "GET"), omr.route_class("/items", "POST"), omr.route_class("/items/" + test_item_dict["identifier"], "GET")
+       ('listing', 'write', 'cheap')
+       >>> control = omr.AdmissionControl(limits=dict(omr.ADMISSION_LIMITS, listing=0), queue_timeout=0)
+       >>> cherrypy.serving.request.path_info = "/items"
+       >>> omr.admit(control)
+       >>> cherrypy.serving.response.status, cherrypy.serving.response.headers["Retry-After"]
+       (503, '1')
+       >>> control.acquire("cheap")
+       True
+       >>> control.release("cheap")
+       >>> cherrypy.serving.request.path_info = "/"
+       >>> cherrypy.serving.response.status = 200
+
+   ### Sessions
+
+   Sessions are off, unless switched on for the routes listed in the
+   [sessions] section of the configuration. They are stored in files,
+   a SQLite database or RAM.
+
+       >>> session_settings = configparser.ConfigParser()
+       >>> omr.session_routes(session_settings)
+       {}
+       >>> session_settings.read_dict({"sessions": {"routes": "/account", "storage": "sqlite", "path": "sessions_test.sqlite"}})
+       >>> list(omr.session_routes(session_settings).keys())
+       ['/account']
+       >>> session_dict = omr.session_config(session_settings)
+       >>> session_dict["tools.sessions.on"], session_dict["tools.sessions.storage_class"] is omr.SQLiteSession
+       (True, True)
+       >>> session_dict["tools.sessions.storage_path"]
+       'sessions_test.sqlite'
+
+   SQLite sessions persist between requests, and expired ones are swept.
+
+       >>> omr.SQLiteSession.setup(storage_path="sessions_test.sqlite")
+       >>> session = omr.SQLiteSession(clean_freq=0)
+       >>> session["account"] = "alice@some.domain"
+       >>> session.save()
+       >>> session = omr.SQLiteSession(session.id, clean_freq=0)
+       >>> session["account"]
+       'alice@some.domain'
+       >>> expired_session = omr.SQLiteSession(clean_freq=0, timeout=0)
+       >>> expired_session["account"] = "eve@some.domain"
+       >>> expired_session.save()
+       >>> expired_session.clean_up()
+       >>> session.connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0], len(session)
+       (1, 1)
+       >>> session.connection().close()
+       >>> del omr.SQLiteSession.connections.connection
+       >>> os.remove("sessions_test.sqlite")
+
   ## Cleanup
 
   Remove any temporary files created in the above.
 
       >>> os.remove("repository.json")
+      >>> os.remove("repository.snapshot")
+      >>> os.remove("repository.snapshot.facets")
+      >>> os.remove("changes.txt")
 """
 
 # This file is part of OpenMediaRepository.
@@ -297,9 +624,54 @@ import cherrypy
 import datetime
 import glob
 import configparser
+import os
+import struct
+import mmap
+import collections.abc
+import multiprocessing
+import cheroot.wsgi
+import threading
+import time
+import urllib.request
+import urllib.parse
+import urllib.error
+import tempfile
+import asyncio
+import concurrent.futures
+import http.client
+import socket
+import random
+import argparse
+import cProfile
+import pstats
+import io
+import html
+import sqlite3
+import pickle
+import cherrypy.lib.sessions
+import tarfile
+import sys
+import signal
+import inspect
 #
 import simple.html
 
+# Optional, for derivatives
+#
+try:
+    import PIL.Image
+
+except ImportError:
+
+    PIL = None
+
+try:
+    import cairosvg
+
+except ImportError:
+
+    cairosvg = None
+
 VERSION = "0.1.0"
 
 LOGGER = logging.getLogger("OpenMediaRepository")
@@ -313,6 +685,143 @@ PORT = 8006
 THREADS = 10
 AUTORELOAD = True
 
+# Number of pre-forked server processes. 1 serves from a single
+# process, as before.
+#
+PROCESSES = 1
+
+SNAPSHOT_PATH = "repository.snapshot"
+
+# Seconds the background snapshot writer waits after a failed dump
+#
+SNAPSHOT_RETRY_INTERVAL = 5
+
+SNAPSHOT_MAGIC = b"OMRSNAP1"
+
+# Header: magic, number of items, width of an index key in bytes.
+# Index entry: key, offset of the JSON record, length of the JSON record.
+#
+SNAPSHOT_HEADER = struct.Struct("<8sQI")
+SNAPSHOT_ENTRY = struct.Struct("<QI")
+
+# Change feed and replication
+#
+LONG_POLL_TIMEOUT = 30
+CHANGES_LIMIT = 1000
+FOLLOWER_STATE_PATH = "follower.json"
+FOLLOWER_RETRY_INTERVAL = 5
+
+# Delta sync for mirrors
+#
+SYNC_LIMIT = 500
+SYNC_MAX_BYTES = 1024 * 1024
+SYNC_TOKEN_PREFIX = 16
+
+# Facets counted for the item listing
+#
+FACETS = ["format", "rights", "creator", "year"]
+
+# Maximum number of items added in one batch
+#
+BATCH_LIMIT = 10000
+
+# Stored media, and their verification
+#
+MEDIA_PATH = "media"
+BLOCK_SIZE = 1024 * 1024
+SCRUB_STATE_PATH = "scrub.json"
+SCRUB_RATE = 4 * 1024 * 1024
+SCRUB_INTERVAL = 24 * 60 * 60
+
+# Content-defined chunking: minimum, average and maximum chunk size,
+# masks of the rolling hash before and after the average size, and the
+# seed of its table. Changing any of these changes chunk boundaries.
+#
+CHUNK_MIN = 16 * 1024
+CHUNK_AVG = 64 * 1024
+CHUNK_MAX = 256 * 1024
+CHUNK_MASK_SMALL = 0x0003f90743530000
+CHUNK_MASK_LARGE = 0x0000d904835b0000
+CHUNK_GEAR_SEED = 20151231
+
+# Derivatives: cache directory and its budget in bytes, bounding box of
+# thumbnails, length of text excerpts in characters, largest source
+# file to render in bytes, and cache file extension per kind.
+#
+DERIVATIVE_PATH = "derivatives"
+DERIVATIVE_BUDGET = 256 * 1024 * 1024
+THUMBNAIL_SIZE = (256, 256)
+EXCERPT_LENGTH = 2000
+DERIVATIVE_SOURCE_LIMIT = 64 * 1024 * 1024
+DERIVATIVE_EXTENSIONS = {"thumbnail": ".png",
+                         "raster": ".png",
+                         "excerpt": ".txt"}
+
+# Archives: name of the header member, version of the archive format,
+# items added between dumps on import, and spooled media files per
+# verifying worker.
+#
+ARCHIVE_HEADER = "openmediarepository.json"
+ARCHIVE_FORMAT = 1
+IMPORT_COMMIT_INTERVAL = 1000
+IMPORT_PENDING_PER_WORKER = 2
+
+# Admission control: concurrent requests per route class, requests
+# allowed to wait per route class, seconds to wait for a slot,
+# Retry-After seconds, and the accept queue length and timeout.
+#
+ADMISSION_LIMITS = {"cheap": 6,
+                    "listing": 2,
+                    "write": 1,
+                    "feed": 4}
+ADMISSION_QUEUES = {"cheap": 8,
+                    "listing": 1,
+                    "write": 4,
+                    "feed": 0}
+ADMISSION_QUEUE_TIMEOUT = 0.5
+ADMISSION_RETRY_AFTER = 1
+ACCEPTED_QUEUE_SIZE = 100
+ACCEPTED_QUEUE_TIMEOUT = 1
+
+# Serving engine, "threaded" (CherryPy) or "asyncio", the seconds an
+# idle keep-alive connection is held by the asyncio engine, and the
+# largest request body it reads, as CherryPy's default.
+#
+ENGINE = "threaded"
+ASYNC_KEEPALIVE_TIMEOUT = 60
+ASYNC_MAX_BODY_SIZE = 100 * 1024 * 1024
+
+# Load tests: request mix weights, and maximum concurrent requests
+#
+LOAD_TEST_MIX = {"/": 1,
+                 "/items": 1,
+                 "/items/<id>": 6,
+                 "/items/add": 1,
+                 "POST /items": 1}
+LOAD_TEST_CONCURRENCY = 64
+
+# Request profiling: fraction of requests sampled, stats directory,
+# stats files kept, and functions shown in the summary
+#
+PROFILE_SAMPLE = 0.01
+PROFILE_PATH = "profiles"
+PROFILE_KEEP = 100
+PROFILE_SUMMARY_LIMIT = 25
+
+# Sessions are off, unless switched on for routes listed in the
+# [sessions] section. Timeout and cleanup frequency are in minutes.
+#
+SESSION_TIMEOUT = 60
+SESSION_CLEAN_FREQ = 5
+SESSION_FILE_PATH = "sessions"
+SESSION_SQLITE_PATH = "sessions.sqlite"
+SESSION_SQLITE_TIMEOUT = 10
+
+# Counters and gauges of this process, served at /metrics
+#
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
 # http://www.dublincore.org/documents/dcmi-terms/#H3
 #
 DUBLIN_CORE_PROPERTIES = {
@@ -365,7 +874,7 @@ class Item:
 
         if fp is not None:
             
-            self.identifier = hashlib.new("whirlpool", fp.read()).hexdigest()
+            self.identifier = whirlpool_digest(fp)
 
         elif "identifier" in kwargs.keys() and kwargs["identifier"]:
 
@@ -397,6 +906,68 @@ class Item:
         except:
             return ""
 
+def count_metric(name, amount = 1):
+    """Add amount to the counter name in METRICS.
+    """
+
+    with METRICS_LOCK:
+
+        METRICS[name] = METRICS.get(name, 0) + amount
+
+    return
+
+def set_metric(name, value):
+    """Set the gauge name in METRICS to value.
+    """
+
+    with METRICS_LOCK:
+
+        METRICS[name] = value
+
+    return
+
+def item_as_dict(item):
+    """Return a dict of the Dublin Core attributes set on item.
+       Missing attributes are not added.
+    """
+
+    item_dict = {}
+
+    for attribute in DUBLIN_CORE_PROPERTIES.keys():
+
+        try:
+            item_dict[attribute] = item.__dict__[attribute]
+
+        except KeyError:
+
+            # Not adding missing attribute
+
+            pass
+
+    return item_dict
+
+def valid_identifier(identifier):
+    """Return True if identifier is acceptable for items added via the HTTP API.
+    """
+
+    return (isinstance(identifier, str)
+            and len(identifier) > 0
+            and identifier.isalnum())
+
+def item_dict_from(fields):
+    """Return an item dict with the Dublin Core keys of the dict fields.
+    """
+
+    item_dict = {"identifier": fields["identifier"]}
+
+    for key in fields.keys():
+
+        if key != "identifier" and key in DUBLIN_CORE_PROPERTIES.keys():
+
+            item_dict[key] = fields[key]
+
+    return item_dict
+
 class Repository:
     """Represent media items, and provide access.
 
@@ -405,6 +976,17 @@ class Repository:
        Repository.items
            A dict, mapping Whirlpool hex digest strings to Item instances
            or an equivalent dict.
+
+       Repository.changes
+           A list of identifiers in the order they were added. The
+           change with sequence number n is Repository.changes[n - 1].
+
+       Repository.condition
+           A threading.Condition, notified whenever an item is added.
+
+       Repository.facets
+           A dict mapping the names in FACETS to collections.Counter
+           instances, counting items per value. Maintained on add.
     """
 
     def __init__(self):
@@ -413,6 +995,16 @@ class Repository:
 
         self.items = {}
 
+        self.changes = []
+
+        self.condition = threading.Condition()
+
+        self.facets = dict([(facet, collections.Counter()) for facet in FACETS])
+
+        # Serialises dumps, so an older one never replaces a newer one
+        #
+        self.dump_lock = threading.Lock()
+
         return
 
     def add(self, item):
@@ -421,426 +1013,5358 @@ class Repository:
            on __getattr__() calls. An Item instance does the latter.
         """
 
-        # First shot: we believe it to already be an Item instance,
-        # or compatible.
-        #
-        try:
-            self.items[item.identifier] = item
+        identifier, item = as_item(item)
 
-        except AttributeError:
+        with self.condition:
 
-            # Apparently not. Let's try with a dict.
+            self.insert(identifier, item)
 
-            try:
+        return
 
-                self.items[item["identifier"]] = Item(**item)
-            
-            except:
+    def insert(self, identifier, item):
+        """Store Item instance item under identifier, count its facets and record the change.
+           Must be called with Repository.condition held.
+        """
 
-                # Giving up
-                #
-                raise RuntimeError("Can not add invalid item to repository: '{0}'".format(repr(item)))
+        if identifier in self.items:
 
-        return
+            # Replaced, uncount the old values
 
-    def dump(self):
-        """Serialise current repository to storage.
-           The default implementation writes the data to a JSON file in CWD.
-        """
+            self.count_facets(self.items[identifier], -1)
 
-        # Make sure we only use dicts
+        self.items[identifier] = item
 
-        dict_to_serialise = {}
+        self.count_facets(item, 1)
 
-        for identifier in self.items.keys():
+        self.changes.append(identifier)
 
-            dict_to_serialise[identifier] = {}
+        self.condition.notify_all()
 
-            for attribute in DUBLIN_CORE_PROPERTIES.keys():
+        return
 
-                try:
-                    dict_to_serialise[identifier][attribute] = self.items[identifier].__dict__[attribute]
+    def count_facets(self, item, amount):
+        """Add amount to the facet counts of the values of item.
+        """
 
-                except KeyError:
+        for facet, value in item_facets(item):
 
-                    # Not adding missing attribute
+            counter = self.facets[facet]
 
-                    pass
+            counter[value] += amount
 
-        with open("repository.json", "wt", encoding="utf8") as fp:
+            if counter[value] <= 0:
 
-            fp.write(json.dumps(dict_to_serialise, sort_keys=True, indent=4) + "\n")
+                del counter[value]
 
         return
 
-    def load(self):
-        """Read repository data from storage.
-           The default implementation reads the data from a JSON file in CWD.
+    def rebuild_facets(self):
+        """Recount the facets over all items.
         """
 
-        items_as_dict = {}
+        facets = dict([(facet, collections.Counter()) for facet in FACETS])
 
-        with open("repository.json", "rt", encoding="utf8") as fp:
+        for identifier in list(self.items.keys()):
 
-            items_as_dict = json.loads(fp.read())
+            for facet, value in item_facets(self.items[identifier]):
 
-        for identifier in items_as_dict.keys():
+                facets[facet][value] += 1
 
-            self.items[identifier] = Item(**items_as_dict[identifier])
+        self.facets = facets
 
         return
 
-class Accounts:
-    """Represent accounts, and provide access.
+    def facet_counts(self):
+        """Return a dict mapping facet names to dicts mapping values to item counts.
+        """
 
-       Attributes:
+        self.refresh()
 
-       Accounts.accounts
-           A dict, mapping email addresses to strings with names,
-           or empty strings if no name is given.
-    """
+        with self.condition:
 
-    def __init__(self):
-        """Initialise.
-        """
+            return dict([(facet, dict(self.facets[facet])) for facet in self.facets.keys()])
 
-        self.accounts = {}
+    def refresh(self):
+        """Pick up changes made by other processes.
+           The default implementation is not shared, and does nothing.
+        """
 
         return
 
-    def add(self, email):
-        """Add the email address as an account.
-           email can be a plain email address, or a string '"Firstname Lastname" <email@address>'.
+    def sequence(self):
+        """Return the sequence number of the latest change whose item can be read.
         """
 
-        email = email.strip()
+        self.refresh()
 
-        # Default: treating as plain email address
+        return len(self.changes)
 
-        email_part = email
+    def recorded(self):
+        """Return the number of recorded changes, including those whose items can not be read yet.
+        """
 
-        name_part = ""
+        self.refresh()
 
-        if email.find("<") > -1:
+        return len(self.changes)
 
-            name_part, email_part = email.split(sep="<", maxsplit=1)
+    def changes_since(self, since, limit = None):
+        """Return a list of (sequence, identifier) tuples for all changes after sequence number since.
+           limit, if given, is the maximum number of changes returned.
+        """
 
-            email_part = email_part.strip(">")
+        self.refresh()
 
-            name_part = name_part.strip().strip('"')
+        since = max(since, 0)
 
-        if email_part in self.accounts.keys():
+        end = self.sequence()
 
-            raise ValueError("Address already exists: '{0}'".format(email_part))
+        if limit is not None:
 
-        self.accounts[email_part] = name_part
+            end = min(end, since + limit)
 
-        return
+        return [(sequence + 1, self.changes[sequence]) for sequence in range(since, end)]
 
-    def dump(self):
-        """Serialise current data to storage.
-           The default implementation writes the data to a plain text file in CWD.
+    def sync_token(self, sequence):
+        """Return an opaque sync token for sequence number sequence.
+           The token carries the first identifier ever added, so tokens
+           issued by a different repository can be told apart.
         """
 
-        with open("accounts.txt", "wt", encoding="utf8") as fp:
-
-            for email_part in self.accounts.keys():
+        if not sequence:
 
-                fp.write('"{0}" <{1}>\n'.format(self.accounts[email_part], email_part))
+            return "0"
 
-        return
+        return "{0}.{1}".format(sequence, self.changes[0][:SYNC_TOKEN_PREFIX])
 
-    def load(self):
-        """Read account data from storage.
-           The default implementation reads the data from a plain text file in CWD,
-           using Accounts.add() for parsing.
+    def sync_sequence(self, token):
+        """Return the sequence number encoded in sync token token.
+           Return None if the token was not issued by this repository,
+           or is malformed.
         """
 
-        with open("accounts.txt", "rt", encoding="utf8") as fp:
+        self.refresh()
 
-            for line in fp.readlines():
+        sequence, dot, prefix = token.partition(".")
 
-                self.add(line)
+        try:
+            sequence = int(sequence)
 
-        return
+        except ValueError:
 
-class ItemsWebApp:
-    """HTTP-REST-Interface to the Repository class, to be mounted in the CherryPy root.
+            return None
 
-       Attributes:
+        if sequence == 0 and not prefix:
 
-       ItemsWebApp.webapp
-           The WebApp instance that this ItemsWebApp instance is attached to.
-    """
+            return 0
 
-    # It is not feasible to expose Repository directly.
-    # OOP uses verbs, while REST is supposed to use nouns.
+        if (sequence < 0
+            or sequence > self.recorded()
+            or self.changes[0][:SYNC_TOKEN_PREFIX] != prefix):
 
-    def __init__(self, webapp):
-        """Initialise ItemsWebApp.
-           webapp is the WebApp instance that this ItemsWebApp instance is attached to.
+            return None
+
+        return sequence
+
+    def wait_for_changes(self, since, timeout):
+        """Block until there are changes after sequence number since, or timeout seconds have passed.
+           Return the current sequence number.
         """
 
-        self.webapp = webapp
+        deadline = time.monotonic() + timeout
 
-        return
+        with self.condition:
 
-    def __call__(self, *args, **kwargs):
-        """List items, or add a given item.
-           Called by cherrypy.
-           HTTP GET calls will submit args.
-           HTTP POST calls will submit kwargs.
-        """
+            while self.sequence() <= since:
 
-        # NOTE: Multiple exit points ahead.
-        
-        page = simple.html.Page("Item", css=self.webapp.css)
-        
-        page.append(self.webapp.config["startpage"]["header"])
+                remaining = deadline - time.monotonic()
 
-        if args:
+                if remaining <= 0:
 
-            if args[0] not in self.webapp.repository.items.keys():
+                    break
 
-                # TODO: Return error code
+                # Wake up regularly, since changes by other processes
+                # do not notify the condition.
                 #
-                page.append("<p>Error: item does not exist</p>")
+                self.condition.wait(min(remaining, 1.0))
 
-                page.append(self.webapp.config["startpage"]["footer"])
-                
-                return str(page)
+        return self.sequence()
 
-            page.append('<ul><li><a href="/">Home</a></li><li><a href="/items">Items</a></li></ul>')
-        
-            # TODO: Item rendering should be done by a special method
-            #
-            page.append("<h1>{0}</h1>".format(self.webapp.repository.items[args[0]].title))
+    def dump(self):
+        """Serialise current repository to storage.
+           The default implementation writes the data to a JSON file in CWD,
+           and the change order to a plain text file in CWD. Both are
+           replaced atomically, so a crash leaves the previous version.
+        """
 
-            page.append("<ul>")
+        with self.dump_lock:
 
+            # Copy under the lock, other threads may add items meanwhile.
+            # Serialise without holding it.
+            #
+            with self.condition:
+
+                items = dict(self.items)
+
+                changes = list(self.changes)
+
+            # Items first: load_changes() appends items missing from
+            # changes.txt, but ignores changes without an item.
+            #
+            self.dump_items(items)
+
+            self.dump_changes(changes)
+
+        return
+
+    def dump_items(self, items):
+        """Write the dict items, mapping identifiers to Item instances, to storage.
+           The default implementation replaces a JSON file in CWD.
+        """
+
+        # Make sure we only use dicts
+
+        dict_to_serialise = {}
+
+        for identifier in items.keys():
+
+            dict_to_serialise[identifier] = item_as_dict(items[identifier])
+
+        write_file_atomically("repository.json", json.dumps(dict_to_serialise, sort_keys=True, indent=4) + "\n")
+
+        return
+
+    def dump_changes(self, changes):
+        """Write the list of identifiers changes as the change order to storage.
+           The default implementation replaces a plain text file in CWD.
+        """
+
+        write_file_atomically("changes.txt", "".join([identifier + "\n" for identifier in changes]))
+
+        return
+
+    def load(self):
+        """Read repository data from storage.
+           The default implementation reads the data from a JSON file in CWD.
+        """
+
+        items_as_dict = {}
+
+        try:
+            with open("repository.json", "rt", encoding="utf8") as fp:
+
+                items_as_dict = json.loads(fp.read())
+
+        except FileNotFoundError:
+
+            # Server processes may have recorded items in changes.txt
+            # before any dump
+            #
+            if not os.path.exists("changes.txt"):
+
+                raise
+
+        for identifier in items_as_dict.keys():
+
+            self.items[identifier] = Item(**items_as_dict[identifier])
+
+        self.changes = load_changes(self.items)
+
+        self.rebuild_facets()
+
+        return
+
+def as_item(item):
+    """Return a tuple (identifier, item), with item as an Item instance or compatible.
+       item is either a dictionary or returns fitting values
+       on __getattr__() calls. An Item instance does the latter.
+    """
+
+    # First shot: we believe it to already be an Item instance,
+    # or compatible.
+    #
+    try:
+        identifier = item.identifier
+
+    except AttributeError:
+
+        # Apparently not. Let's try with a dict.
+
+        try:
+
+            identifier = item["identifier"]
+
+            item = Item(**item)
+        
+        except:
+
+            # Giving up
+            #
+            raise RuntimeError("Can not add invalid item to repository: '{0}'".format(repr(item)))
+
+    return (identifier, item)
+
+def item_facets(item):
+    """Return a list of (facet, value) tuples for the non-empty facet values of item.
+       The 'year' facet are the leading four digits of the date.
+    """
+
+    facets = []
+
+    for facet in FACETS:
+
+        if facet == "year":
+
+            value = str(getattr(item, "date", "") or "")[:4]
+
+            if len(value) != 4 or not value.isdigit():
+
+                value = ""
+
+        else:
+            value = str(getattr(item, facet, "") or "")
+
+        if value:
+
+            facets.append((facet, value))
+
+    return facets
+
+def change_line(identifier, item):
+    """Return the line recording the change of identifier to Item instance item in changes.txt, as bytes.
+    """
+
+    return "{0}\t{1}\n".format(identifier, json.dumps(item_as_dict(item), sort_keys=True)).encode("utf8")
+
+def parse_change_line(line):
+    """Return a tuple (identifier, item dict) for a line of changes.txt.
+       The item dict is None for lines holding only the identifier.
+    """
+
+    identifier, tab, record = line.strip().partition("\t")
+
+    if not record:
+
+        return (identifier, None)
+
+    return (identifier, json.loads(record))
+
+def load_changes(items):
+    """Return the list of changes stored in changes.txt in CWD.
+       Item records in changes.txt are stored in items, in order, so
+       items added by a server process that did not dump are not lost.
+       Identifiers not in items are dropped. Items without a recorded
+       change, e.g. from a repository.json written by an earlier
+       version, are appended in sorted order.
+    """
+
+    changes = []
+
+    try:
+        with open("changes.txt", "rt", encoding="utf8") as fp:
+
+            for line in fp.readlines():
+
+                identifier, item_dict = parse_change_line(line)
+
+                if item_dict is not None:
+
+                    items[identifier] = Item(**item_dict)
+
+                if identifier and identifier in items:
+
+                    changes.append(identifier)
+
+    except FileNotFoundError:
+
+        # No changes recorded yet
+
+        pass
+
+    recorded = set(changes)
+
+    changes.extend(sorted([identifier for identifier in items.keys() if identifier not in recorded]))
+
+    return changes
+
+def write_snapshot(items, path = SNAPSHOT_PATH, facets = None):
+    """Write items to a snapshot file that can be memory-mapped read-only.
+       items is a dict-like mapping identifiers to Item instances.
+       The file is written to a temporary name first, and then renamed
+       into place, so that readers always see a complete snapshot.
+       facets, if given, are the facet counts of items as in
+       Repository.facets, and are written to path + ".facets" first.
+    """
+
+    if facets is not None:
+
+        write_file_atomically(path + ".facets",
+                              json.dumps(dict([(facet, dict(facets[facet])) for facet in facets.keys()]), sort_keys=True))
+
+    records = []
+
+    for identifier, item in list(items.items()):
+
+        records.append((identifier.encode("utf8"),
+                        json.dumps(item_as_dict(item), sort_keys=True).encode("utf8")))
+
+    records.sort()
+
+    key_width = max([len(key) for key, record in records] + [1])
+
+    index_size = len(records) * (key_width + SNAPSHOT_ENTRY.size)
+
+    offset = SNAPSHOT_HEADER.size + index_size
+
+    temporary_path = "{0}.{1}.tmp".format(path, os.getpid())
+
+    with open(temporary_path, "wb") as fp:
+
+        fp.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(records), key_width))
+
+        for key, record in records:
+
+            fp.write(key.ljust(key_width, b"\0"))
+
+            fp.write(SNAPSHOT_ENTRY.pack(offset, len(record)))
+
+            offset += len(record)
+
+        for key, record in records:
+
+            fp.write(record)
+
+        fp.flush()
+
+        os.fsync(fp.fileno())
+
+    os.replace(temporary_path, path)
+
+    return
+
+def read_snapshot_facets(path = SNAPSHOT_PATH):
+    """Return the facet counts written along with the snapshot at path, as in Repository.facets.
+       Return None if there are none.
+    """
+
+    try:
+        with open(path + ".facets", "rt", encoding="utf8") as fp:
+
+            counts = json.loads(fp.read())
+
+    except FileNotFoundError:
+
+        return None
+
+    return dict([(facet, collections.Counter(counts.get(facet, {}))) for facet in FACETS])
+
+class SnapshotItems(collections.abc.Mapping):
+    """A read-only dict-like view on a memory-mapped snapshot file.
+
+       Lookups are binary searches in the sorted index of the snapshot,
+       so the catalogue is shared between all processes mapping the same
+       file instead of being copied into each of them.
+
+       Items added locally are kept in SnapshotItems.added until the
+       same records show up in a newer snapshot.
+
+       Attributes:
+
+       SnapshotItems.path
+           Path to the snapshot file.
+
+       SnapshotItems.generation
+           A multiprocessing.Value, incremented whenever a new snapshot
+           has been written, or None.
+
+       SnapshotItems.added
+           A dict of items added since the current snapshot was mapped.
+    """
+
+    def __init__(self, path = SNAPSHOT_PATH, generation = None):
+        """Initialise, and map the snapshot if it exists.
+           generation, if given, is a shared multiprocessing.Value that
+           is compared on every access to detect new snapshots.
+        """
+
+        self.path = path
+
+        self.generation = generation
+
+        self.added = {}
+
+        # (mmap or None, number of items, key width, generation)
+        #
+        self.snapshot = (None, 0, 1, 0)
+
+        self.open()
+
+        return
+
+    def open(self):
+        """(Re-)map the current snapshot file.
+        """
+
+        generation = 0
+
+        if self.generation is not None:
+
+            generation = self.generation.value
+
+        try:
+            with open(self.path, "rb") as fp:
+
+                mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except (FileNotFoundError, ValueError):
+
+            # Missing or empty file, no snapshot yet
+
+            self.snapshot = (None, 0, 1, generation)
+
+            return
+
+        magic, count, key_width = SNAPSHOT_HEADER.unpack_from(mapped, 0)
+
+        if magic != SNAPSHOT_MAGIC:
+
+            raise RuntimeError("Not a repository snapshot: '{0}'".format(self.path))
+
+        # Swap in one assignment, so concurrent readers see either the
+        # old or the new snapshot. The old mmap is closed once the last
+        # reader drops it.
+        #
+        self.snapshot = (mapped, count, key_width, generation)
+
+        # Keep replacements until the snapshot holds the same record
+        #
+        for identifier in list(self.added.keys()):
+
+            stored = self.stored(identifier, self.snapshot)
+
+            if stored is not None and item_as_dict(stored) == item_as_dict(self.added[identifier]):
+
+                self.added.pop(identifier, None)
+
+        return
+
+    def _current(self):
+        """Return the current snapshot tuple, re-mapping first if a newer snapshot has been announced.
+        """
+
+        if self.generation is not None and self.generation.value != self.snapshot[3]:
+
+            self.open()
+
+        return self.snapshot
+
+    def _key(self, snapshot, index):
+        """Return the identifier bytes at index of the snapshot index.
+        """
+
+        mapped, count, key_width, generation = snapshot
+
+        position = SNAPSHOT_HEADER.size + index * (key_width + SNAPSHOT_ENTRY.size)
+
+        return mapped[position:position + key_width].rstrip(b"\0")
+
+    def _find(self, identifier, snapshot = None):
+        """Return the (offset, length) of the record for identifier, or None.
+        """
+
+        if snapshot is None:
+
+            snapshot = self.snapshot
+
+        mapped, count, key_width, generation = snapshot
+
+        if mapped is None:
+
+            return None
+
+        key = identifier.encode("utf8")
+
+        low = 0
+
+        high = count
+
+        while low < high:
+
+            middle = (low + high) // 2
+
+            if self._key(snapshot, middle) < key:
+
+                low = middle + 1
+
+            else:
+                high = middle
+
+        if low < count and self._key(snapshot, low) == key:
+
+            position = SNAPSHOT_HEADER.size + low * (key_width + SNAPSHOT_ENTRY.size) + key_width
+
+            return SNAPSHOT_ENTRY.unpack_from(mapped, position)
+
+        return None
+
+    def stored(self, identifier, snapshot = None):
+        """Return the item stored for identifier in the snapshot, ignoring SnapshotItems.added, or None.
+        """
+
+        if snapshot is None:
+
+            snapshot = self._current()
+
+        entry = self._find(identifier, snapshot)
+
+        if entry is None:
+
+            return None
+
+        offset, length = entry
+
+        return Item(**json.loads(snapshot[0][offset:offset + length].decode("utf8")))
+
+    def __getitem__(self, identifier):
+
+        snapshot = self._current()
+
+        if identifier in self.added.keys():
+
+            return self.added[identifier]
+
+        entry = self._find(identifier, snapshot)
+
+        if entry is None:
+
+            raise KeyError(identifier)
+
+        offset, length = entry
+
+        return Item(**json.loads(snapshot[0][offset:offset + length].decode("utf8")))
+
+    def __setitem__(self, identifier, item):
+
+        self.added[identifier] = item
+
+        return
+
+    def __contains__(self, identifier):
+
+        return (identifier in self.added.keys()
+                or self._find(identifier, self._current()) is not None)
+
+    def __iter__(self):
+
+        snapshot = self._current()
+
+        for identifier in list(self.added.keys()):
+
+            yield identifier
+
+        for index in range(snapshot[1]):
+
+            identifier = self._key(snapshot, index).decode("utf8")
+
+            if identifier not in self.added.keys():
+
+                yield identifier
+
+    def copy(self):
+        """Return a SnapshotItems of the current snapshot and added items, unaffected by later changes.
+        """
+
+        copy = SnapshotItems.__new__(SnapshotItems)
+
+        copy.path = self.path
+
+        copy.generation = None
+
+        copy.snapshot = self._current()
+
+        copy.added = dict(self.added)
+
+        return copy
+
+    def items(self):
+        """Yield (identifier, Item) tuples for all items.
+           The index is walked in order, without a binary search per item.
+        """
+
+        snapshot = self._current()
+
+        mapped, count, key_width, generation = snapshot
+
+        for identifier in list(self.added.keys()):
+
+            yield (identifier, self.added[identifier])
+
+        for index in range(count):
+
+            identifier = self._key(snapshot, index).decode("utf8")
+
+            if identifier not in self.added.keys():
+
+                position = SNAPSHOT_HEADER.size + index * (key_width + SNAPSHOT_ENTRY.size) + key_width
+
+                offset, length = SNAPSHOT_ENTRY.unpack_from(mapped, position)
+
+                yield (identifier, Item(**json.loads(mapped[offset:offset + length].decode("utf8"))))
+
+    def __len__(self):
+
+        snapshot = self._current()
+
+        return snapshot[1] + len([identifier for identifier in self.added.keys()
+                                  if self._find(identifier, snapshot) is None])
+
+class SharedRepository(Repository):
+    """A Repository backed by a memory-mapped snapshot shared between server processes.
+
+       Reads go to the snapshot. Repository.add() appends the identifier
+       and the item record to changes.txt under a lock shared by all
+       processes, so sequence numbers are assigned once for all of them,
+       and changes.txt is only ever appended to. Repository.dump() writes
+       repository.json and a new snapshot under a second shared lock, so
+       adding does not wait for it, and then notifies the other processes
+       by incrementing the shared generation.
+
+       Other processes read the records from changes.txt, so a change is
+       readable everywhere as soon as it is recorded, whether or not the
+       process that added it ever dumps.
+
+       Attributes:
+
+       SharedRepository.lock
+           A multiprocessing.Lock serialising appends to changes.txt.
+
+       SharedRepository.generation
+           A multiprocessing.Value counting written snapshots.
+
+       SharedRepository.snapshot_lock
+           A multiprocessing.Lock serialising dumps.
+
+       SharedRepository.changes_offset
+           Number of bytes of changes.txt read into Repository.changes.
+    """
+
+    def __init__(self, lock, generation, snapshot_lock):
+        """Initialise.
+           lock, generation and snapshot_lock must be created before the
+           server processes are forked.
+        """
+
+        Repository.__init__(self)
+
+        self.lock = lock
+
+        self.generation = generation
+
+        self.snapshot_lock = snapshot_lock
+
+        self.items = SnapshotItems(SNAPSHOT_PATH, generation)
+
+        self.changes_offset = 0
+
+        # Snapshot generation that self.facets was counted for
+        #
+        self.changes_generation = None
+
+        return
+
+    def read_changes(self):
+        """Apply the changes appended to changes.txt since the last call.
+           Changes with an item record store the item, see change_line().
+           Must be called with Repository.condition held.
+        """
+
+        try:
+            with open("changes.txt", "rb") as fp:
+
+                fp.seek(self.changes_offset)
+
+                data = fp.read()
+
+        except FileNotFoundError:
+
+            # No changes recorded yet
+
+            return
+
+        # A line may be in the middle of being written
+        #
+        end = data.rfind(b"\n") + 1
+
+        for line in data[:end].decode("utf8").splitlines():
+
+            identifier, item_dict = parse_change_line(line)
+
+            if item_dict is None:
+
+                # Recorded before serving, the item is in the snapshot
+
+                self.changes.append(identifier)
+
+            else:
+                self.insert(identifier, Item(**item_dict))
+
+        self.changes_offset += end
+
+        return
+
+    def refresh(self):
+        """Pick up changes recorded and snapshots published by other processes.
+        """
+
+        with self.condition:
+
+            self.read_changes()
+
+            generation = self.items._current()[3]
+
+            if generation != self.changes_generation:
+
+                self.count_published_facets()
+
+                self.changes_generation = generation
+
+        return
+
+    def count_published_facets(self):
+        """Set Repository.facets to the counts published with the snapshot, plus the items added locally since.
+           Must be called with Repository.condition held.
+        """
+
+        facets = read_snapshot_facets(self.items.path)
+
+        if facets is None:
+
+            # Snapshot without counts, count once
+            #
+            self.rebuild_facets()
+
+            return
+
+        self.facets = facets
+
+        for identifier in list(self.items.added.keys()):
+
+            stored = self.items.stored(identifier)
+
+            if stored is not None:
+
+                self.count_facets(stored, -1)
+
+            self.count_facets(self.items.added[identifier], 1)
+
+        return
+
+    def add(self, item):
+        """Add an item, and record the change in changes.txt for all processes.
+        """
+
+        identifier, item = as_item(item)
+
+        line = change_line(identifier, item)
+
+        # The position in changes.txt numbers the change. The item is
+        # stored when the line is read back, in order after every change
+        # recorded before.
+        #
+        with self.lock:
+
+            with open("changes.txt", "ab") as fp:
+
+                fp.write(line)
+
+        self.refresh()
+
+        return
+
+    def dump(self):
+        """Persist items added by this process, and publish a new snapshot.
+           changes.txt is up to date already.
+        """
+
+        with self.snapshot_lock:
+
+            # Pick up changes from other processes first, so they are
+            # not lost in the new snapshot.
+            #
+            self.refresh()
+
+            # Repository.facets count the items of this copy. Decode it
+            # once, without holding the condition.
+            #
+            with self.condition:
+
+                items = self.items.copy()
+
+                facets = dict([(facet, collections.Counter(self.facets[facet])) for facet in self.facets.keys()])
+
+            items = dict(items.items())
+
+            self.dump_items(items)
+
+            write_snapshot(items, SNAPSHOT_PATH, facets)
+
+            self.generation.value += 1
+
+            self.refresh()
+
+        return
+
+    def dump_changes(self, changes):
+        """Do nothing, Repository.add() has appended the changes to changes.txt already.
+        """
+
+        return
+
+    def load(self):
+        """Map the current snapshot, and read changes.txt.
+        """
+
+        self.items.open()
+
+        with self.condition:
+
+            self.changes = []
+
+            self.changes_offset = 0
+
+            self.changes_generation = None
+
+        self.refresh()
+
+        return
+
+def write_file_atomically(path, text):
+    """Write string text to path, so that after a crash path holds either the old or the new text.
+       The text goes to a temporary file in the same directory, which
+       is synced to disk and then renamed over path.
+    """
+
+    temporary_path = "{0}.{1}.{2}.tmp".format(path, os.getpid(), threading.get_ident())
+
+    with open(temporary_path, "wt", encoding="utf8") as fp:
+
+        fp.write(text)
+
+        fp.flush()
+
+        os.fsync(fp.fileno())
+
+    os.replace(temporary_path, path)
+
+    # Make the rename itself durable
+    #
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+
+    try:
+        os.fsync(directory)
+
+    finally:
+        os.close(directory)
+
+    return
+
+class SnapshotWriter:
+    """Persist a Repository with Repository.dump() in a background thread.
+
+       Requests made while a dump is being written are coalesced into a
+       single further dump. Until SnapshotWriter.start() is called,
+       requests dump synchronously.
+
+       Attributes:
+
+       SnapshotWriter.repository
+           The Repository instance to persist.
+
+       SnapshotWriter.requested
+           Number of dump requests so far.
+
+       SnapshotWriter.written
+           Number of those requests covered by a successful dump.
+
+       SnapshotWriter.last_snapshot
+           time.time() of the last successful dump, or None.
+    """
+
+    def __init__(self, repository, retry_interval = SNAPSHOT_RETRY_INTERVAL):
+        """Initialise.
+           retry_interval is the number of seconds to wait after a failed dump.
+        """
+
+        self.repository = repository
+
+        self.retry_interval = retry_interval
+
+        self.requested = 0
+
+        self.written = 0
+
+        self.last_snapshot = None
+
+        self.condition = threading.Condition()
+
+        self.stopping = False
+
+        self.thread = None
+
+        return
+
+    def request(self):
+        """Ask for the repository to be persisted.
+           Returns at once if the writer thread is running.
+        """
+
+        count_metric("snapshot_requests")
+
+        with self.condition:
+
+            self.requested += 1
+
+            running = self.thread is not None
+
+            self.condition.notify_all()
+
+        if not running:
+
+            self.write()
+
+        return
+
+    def write(self):
+        """Dump the repository, covering all requests made so far.
+           Exceptions of Repository.dump() are passed on.
+        """
+
+        with self.condition:
+
+            requested = self.requested
+
+        started = time.monotonic()
+
+        try:
+            self.repository.dump()
+
+        except Exception:
+
+            count_metric("snapshot_failures")
+
+            raise
+
+        with self.condition:
+
+            self.written = max(self.written, requested)
+
+            self.last_snapshot = time.time()
+
+            self.condition.notify_all()
+
+        count_metric("snapshot_writes")
+
+        set_metric("snapshot_last_success", self.last_snapshot)
+
+        set_metric("snapshot_seconds", time.monotonic() - started)
+
+        return
+
+    def flush(self, timeout = None):
+        """Block until all requests made so far are written, or timeout seconds have passed.
+           Return True if they are written.
+        """
+
+        with self.condition:
+
+            requested = self.requested
+
+            return self.condition.wait_for(lambda: self.written >= requested, timeout)
+
+    def run(self):
+        """Write dumps until SnapshotWriter.stop() is called and nothing is pending.
+        """
+
+        while True:
+
+            with self.condition:
+
+                self.condition.wait_for(lambda: self.written < self.requested or self.stopping)
+
+                if self.written >= self.requested:
+
+                    # Stopping, and nothing pending
+                    #
+                    break
+
+            try:
+                self.write()
+
+            except Exception as error:
+
+                LOGGER.error("Repository snapshot failed: {0}".format(error))
+
+                if self.stopping:
+
+                    break
+
+                with self.condition:
+
+                    self.condition.wait(self.retry_interval)
+
+        return
+
+    def start(self):
+        """Start writing in a background thread.
+        """
+
+        with self.condition:
+
+            self.stopping = False
+
+            self.thread = threading.Thread(target=self.run, name="SnapshotWriter", daemon=True)
+
+        self.thread.start()
+
+        return
+
+    def stop(self):
+        """Write pending requests, and stop the background thread.
+        """
+
+        with self.condition:
+
+            self.stopping = True
+
+            thread = self.thread
+
+            self.condition.notify_all()
+
+        if thread is not None:
+
+            thread.join()
+
+        with self.condition:
+
+            self.thread = None
+
+        return
+
+class Accounts:
+    """Represent accounts, and provide access.
+
+       Attributes:
+
+       Accounts.accounts
+           A dict, mapping email addresses to strings with names,
+           or empty strings if no name is given.
+    """
+
+    def __init__(self):
+        """Initialise.
+        """
+
+        self.accounts = {}
+
+        return
+
+    def add(self, email):
+        """Add the email address as an account.
+           email can be a plain email address, or a string '"Firstname Lastname" <email@address>'.
+        """
+
+        email = email.strip()
+
+        # Default: treating as plain email address
+
+        email_part = email
+
+        name_part = ""
+
+        if email.find("<") > -1:
+
+            name_part, email_part = email.split(sep="<", maxsplit=1)
+
+            email_part = email_part.strip(">")
+
+            name_part = name_part.strip().strip('"')
+
+        if email_part in self.accounts.keys():
+
+            raise ValueError("Address already exists: '{0}'".format(email_part))
+
+        self.accounts[email_part] = name_part
+
+        return
+
+    def dump(self):
+        """Serialise current data to storage.
+           The default implementation writes the data to a plain text file in CWD.
+        """
+
+        with open("accounts.txt", "wt", encoding="utf8") as fp:
+
+            for email_part in self.accounts.keys():
+
+                fp.write('"{0}" <{1}>\n'.format(self.accounts[email_part], email_part))
+
+        return
+
+    def load(self):
+        """Read account data from storage.
+           The default implementation reads the data from a plain text file in CWD,
+           using Accounts.add() for parsing.
+        """
+
+        with open("accounts.txt", "rt", encoding="utf8") as fp:
+
+            for line in fp.readlines():
+
+                self.add(line)
+
+        return
+
+def whirlpool_digest(fp, rate = None):
+    """Return the Whirlpool hex digest of the binary file fp, reading it in blocks.
+       rate, if given, limits reading to about rate bytes per second.
+    """
+
+    digest = hashlib.new("whirlpool")
+
+    started = time.monotonic()
+
+    size = 0
+
+    block = fp.read(BLOCK_SIZE)
+
+    while block:
+
+        digest.update(block)
+
+        size += len(block)
+
+        if rate:
+
+            # Sleep until we are back below the given rate
+            #
+            ahead = size / rate - (time.monotonic() - started)
+
+            if ahead > 0:
+
+                time.sleep(ahead)
+
+        block = fp.read(BLOCK_SIZE)
+
+    return digest.hexdigest()
+
+class MediaStore:
+    """Content-addressed storage of media files.
+
+       Files are stored as MediaStore.path/<first two characters>/<identifier>.
+
+       Attributes:
+
+       MediaStore.path
+           Path to the root directory of the store.
+    """
+
+    def __init__(self, path = MEDIA_PATH):
+        """Initialise.
+        """
+
+        self.path = path
+
+        return
+
+    def filename(self, identifier):
+        """Return the path of the file stored for identifier.
+        """
+
+        if not identifier.isalnum():
+
+            raise ValueError("Invalid identifier: '{0}'".format(identifier))
+
+        return os.path.join(self.path, identifier[:2], identifier)
+
+    def store(self, fp):
+        """Store the content of the binary file fp, and return its identifier.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        temporary_path = os.path.join(self.path, "upload.{0}.{1}.tmp".format(os.getpid(), threading.get_ident()))
+
+        digest = hashlib.new("whirlpool")
+
+        with open(temporary_path, "wb") as temporary_fp:
+
+            block = fp.read(BLOCK_SIZE)
+
+            while block:
+
+                digest.update(block)
+
+                temporary_fp.write(block)
+
+                block = fp.read(BLOCK_SIZE)
+
+        identifier = digest.hexdigest()
+
+        os.makedirs(os.path.dirname(self.filename(identifier)), exist_ok=True)
+
+        os.replace(temporary_path, self.filename(identifier))
+
+        return identifier
+
+    def open(self, identifier):
+        """Return a binary file object for the content stored for identifier.
+        """
+
+        return open(self.filename(identifier), "rb")
+
+    def __contains__(self, identifier):
+
+        return os.path.isfile(self.filename(identifier))
+
+    def size(self, identifier):
+        """Return the size in bytes of the content stored for identifier.
+        """
+
+        return os.path.getsize(self.filename(identifier))
+
+    def identifiers(self):
+        """Return a sorted list of all stored identifiers.
+        """
+
+        identifiers = []
+
+        for path in glob.glob(os.path.join(self.path, "*", "*")):
+
+            identifier = os.path.basename(path)
+
+            if identifier.isalnum():
+
+                identifiers.append(identifier)
+
+        identifiers.sort()
+
+        return identifiers
+
+def gear_table():
+    """Return the 256 random 64 bit values of the Gear rolling hash.
+       The table is fixed by a seed, since chunk boundaries must not
+       change between runs.
+    """
+
+    generator = random.Random(CHUNK_GEAR_SEED)
+
+    return [generator.getrandbits(64) for value in range(256)]
+
+GEAR = gear_table()
+
+def chunk_boundaries(data, final = False):
+    """Return the end offsets of the content-defined chunks in bytes data.
+       Uses FastCDC: a Gear rolling hash, no cuts before CHUNK_MIN,
+       a stricter mask before CHUNK_AVG and a looser one after it, and a
+       forced cut at CHUNK_MAX. The last, incomplete chunk is only
+       included if final is True.
+    """
+
+    boundaries = []
+
+    gear = GEAR
+
+    mask_small = CHUNK_MASK_SMALL
+
+    mask_large = CHUNK_MASK_LARGE
+
+    start = 0
+
+    length = len(data)
+
+    while length - start >= CHUNK_MAX or (final and start < length):
+
+        end = min(start + CHUNK_MAX, length)
+
+        normal = min(start + CHUNK_AVG, end)
+
+        position = min(start + CHUNK_MIN, end)
+
+        cut = end
+
+        fingerprint = 0
+
+        while position < normal:
+
+            fingerprint = ((fingerprint << 1) + gear[data[position]]) & 0xFFFFFFFFFFFFFFFF
+
+            position += 1
+
+            if not fingerprint & mask_small:
+
+                cut = position
+
+                break
+
+        else:
+            while position < end:
+
+                fingerprint = ((fingerprint << 1) + gear[data[position]]) & 0xFFFFFFFFFFFFFFFF
+
+                position += 1
+
+                if not fingerprint & mask_large:
+
+                    cut = position
+
+                    break
+
+        boundaries.append(cut)
+
+        start = cut
+
+    return boundaries
+
+class ChunkReader(io.RawIOBase):
+    """A binary file object reassembling a file from its chunks.
+    """
+
+    def __init__(self, store, chunks):
+        """Initialise.
+           store is the ChunkedMediaStore, chunks is the list of chunk digests.
+        """
+
+        io.RawIOBase.__init__(self)
+
+        self.store = store
+
+        self.chunks = list(chunks)
+
+        self.buffer = b""
+
+        self.offset = 0
+
+        self.position = 0
+
+        return
+
+    def readable(self):
+
+        return True
+
+    def readinto(self, buffer):
+
+        while self.offset == len(self.buffer) and self.chunks:
+
+            started = time.monotonic()
+
+            with open(self.store.chunk_filename(self.chunks.pop(0)), "rb") as fp:
+
+                self.buffer = fp.read()
+
+            self.offset = 0
+
+            count_metric("chunk_read_seconds", time.monotonic() - started)
+
+        size = min(len(buffer), len(self.buffer) - self.offset)
+
+        buffer[:size] = self.buffer[self.offset:self.offset + size]
+
+        self.offset += size
+
+        self.position += size
+
+        count_metric("chunk_read_bytes", size)
+
+        return size
+
+    def tell(self):
+
+        return self.position
+
+class ChunkedMediaStore(MediaStore):
+    """Content-addressed storage of media files, deduplicated by content-defined chunks.
+
+       Files are split with chunk_boundaries(), and each distinct chunk
+       is stored once as MediaStore.path/chunks/<first two characters>/<SHA-256 digest>.
+       A manifest listing the chunks of a file is stored as
+       MediaStore.path/manifests/<first two characters>/<identifier>.
+       Identifiers remain the Whirlpool digest of the whole file.
+
+       The rolling hash runs byte by byte in Python, at some MB/s, so
+       chunk boundaries are searched in a process pool. Storing a large
+       file then takes a while, but does not hold the GIL of the
+       calling process.
+
+       Attributes:
+
+       ChunkedMediaStore.logical_bytes
+           Total size of the stored files.
+
+       ChunkedMediaStore.physical_bytes
+           Total size of the stored chunks.
+
+       ChunkedMediaStore.processes
+           Number of worker processes searching chunk boundaries, None
+           for one per CPU.
+    """
+
+    def __init__(self, path = MEDIA_PATH, processes = None):
+        """Initialise, and total the sizes of stored files and chunks.
+        """
+
+        MediaStore.__init__(self, path)
+
+        self.lock = threading.Lock()
+
+        self.processes = processes
+
+        self.executor = None
+
+        self.logical_bytes = 0
+
+        self.physical_bytes = 0
+
+        for identifier in self.identifiers():
+
+            self.logical_bytes += self.manifest(identifier)["size"]
+
+        for filename in glob.glob(os.path.join(self.path, "chunks", "*", "*")):
+
+            self.physical_bytes += os.path.getsize(filename)
+
+        self.update_metrics()
+
+        return
+
+    def filename(self, identifier):
+        """Return the path of the manifest stored for identifier.
+        """
+
+        if not identifier.isalnum():
+
+            raise ValueError("Invalid identifier: '{0}'".format(identifier))
+
+        return os.path.join(self.path, "manifests", identifier[:2], identifier)
+
+    def chunk_filename(self, digest):
+        """Return the path of the chunk with SHA-256 hex digest digest.
+        """
+
+        return os.path.join(self.path, "chunks", digest[:2], digest)
+
+    def manifest(self, identifier):
+        """Return the manifest dict of identifier, with the keys 'size' and 'chunks'.
+        """
+
+        with open(self.filename(identifier), "rt", encoding="utf8") as fp:
+
+            return json.loads(fp.read())
+
+    def store_chunk(self, chunk):
+        """Store bytes chunk unless already present, and return its digest.
+        """
+
+        digest = hashlib.sha256(chunk).hexdigest()
+
+        filename = self.chunk_filename(digest)
+
+        if not os.path.exists(filename):
+
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+            temporary_path = "{0}.{1}.{2}.tmp".format(filename, os.getpid(), threading.get_ident())
+
+            with open(temporary_path, "wb") as fp:
+
+                fp.write(chunk)
+
+            # Count the chunk once, if another thread stored it meanwhile
+            #
+            with self.lock:
+
+                if not os.path.exists(filename):
+
+                    self.physical_bytes += len(chunk)
+
+                os.replace(temporary_path, filename)
+
+        return digest
+
+    def boundaries(self, data, final):
+        """Return chunk_boundaries(data, final), searched in a worker process.
+        """
+
+        if len(data) <= CHUNK_MIN:
+
+            # Nothing to search
+            #
+            return chunk_boundaries(data, final)
+
+        with self.lock:
+
+            if self.executor is None:
+
+                # Forking a threaded server is unsafe, start fresh interpreters
+                #
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.processes,
+                                                                       mp_context=multiprocessing.get_context("spawn"))
+
+            executor = self.executor
+
+        return executor.submit(chunk_boundaries, data, final).result()
+
+    def store(self, fp):
+        """Store the content of the binary file fp in chunks, and return its identifier.
+        """
+
+        started = time.monotonic()
+
+        digest = hashlib.new("whirlpool")
+
+        chunks = []
+
+        size = 0
+
+        data = b""
+
+        block = fp.read(BLOCK_SIZE)
+
+        while True:
+
+            final = not block
+
+            digest.update(block)
+
+            size += len(block)
+
+            data += block
+
+            start = 0
+
+            for end in self.boundaries(data, final):
+
+                chunks.append(self.store_chunk(data[start:end]))
+
+                start = end
+
+            data = data[start:]
+
+            if final:
+
+                break
+
+            block = fp.read(BLOCK_SIZE)
+
+        identifier = digest.hexdigest()
+
+        filename = self.filename(identifier)
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        temporary_path = "{0}.{1}.{2}.tmp".format(filename, os.getpid(), threading.get_ident())
+
+        with open(temporary_path, "wt", encoding="utf8") as manifest_fp:
+
+            manifest_fp.write(json.dumps({"size": size, "chunks": chunks}))
+
+        # Count files stored before only once
+        #
+        with self.lock:
+
+            if not os.path.exists(filename):
+
+                self.logical_bytes += size
+
+            os.replace(temporary_path, filename)
+
+        count_metric("chunk_write_bytes", size)
+
+        count_metric("chunk_write_seconds", time.monotonic() - started)
+
+        self.update_metrics()
+
+        return identifier
+
+    def open(self, identifier):
+        """Return a binary file object reassembling the content stored for identifier.
+        """
+
+        # Buffered, so read(n) does not stop short at chunk boundaries
+        #
+        return io.BufferedReader(ChunkReader(self, self.manifest(identifier)["chunks"]))
+
+    def size(self, identifier):
+        """Return the size in bytes of the content stored for identifier.
+        """
+
+        return self.manifest(identifier)["size"]
+
+    def identifiers(self):
+        """Return a sorted list of all stored identifiers.
+        """
+
+        identifiers = []
+
+        for path in glob.glob(os.path.join(self.path, "manifests", "*", "*")):
+
+            identifier = os.path.basename(path)
+
+            if identifier.isalnum():
+
+                identifiers.append(identifier)
+
+        identifiers.sort()
+
+        return identifiers
+
+    def statistics(self):
+        """Return a dict with sizes, the dedup ratio, and read and write throughput in bytes per second.
+        """
+
+        with METRICS_LOCK:
+
+            metrics = dict(METRICS)
+
+        statistics = {"logical_bytes": self.logical_bytes,
+                      "physical_bytes": self.physical_bytes,
+                      "dedup_ratio": None,
+                      "write_throughput": None,
+                      "read_throughput": None}
+
+        if self.physical_bytes:
+
+            statistics["dedup_ratio"] = round(self.logical_bytes / self.physical_bytes, 3)
+
+        for operation in ("write", "read"):
+
+            if metrics.get("chunk_{0}_seconds".format(operation)):
+
+                statistics[operation + "_throughput"] = round(metrics["chunk_{0}_bytes".format(operation)] / metrics["chunk_{0}_seconds".format(operation)])
+
+        return statistics
+
+    def update_metrics(self):
+        """Publish the dedup ratio in METRICS.
+        """
+
+        if self.physical_bytes:
+
+            set_metric("chunk_dedup_ratio", round(self.logical_bytes / self.physical_bytes, 3))
+
+        return
+
+    def stop(self):
+        """Shut down the worker processes.
+        """
+
+        with self.lock:
+
+            executor = self.executor
+
+            self.executor = None
+
+        if executor is not None:
+
+            executor.shutdown()
+
+        return
+
+def media_store(config):
+    """Return the MediaStore configured in the [media] section of config.
+       storage is 'files' (default) or 'chunks'. Chunking costs far more
+       CPU than storing whole files: the boundary search runs at some
+       MB/s, against hundreds of MB/s for plain files. It runs in worker
+       processes, so serving threads are not stalled, but large uploads
+       take correspondingly longer.
+    """
+
+    storage = config.get("media", "storage", fallback="files")
+
+    path = config.get("media", "path", fallback=MEDIA_PATH)
+
+    if storage == "chunks":
+
+        return ChunkedMediaStore(path)
+
+    if storage != "files":
+
+        raise ValueError("Unknown media storage: '{0}'".format(storage))
+
+    return MediaStore(path)
+
+def scrub_report():
+    """Return the state saved by the Scrubber in SCRUB_STATE_PATH as a dict, or an empty dict if it never ran.
+    """
+
+    try:
+        with open(SCRUB_STATE_PATH, "rt", encoding="utf8") as fp:
+
+            return json.loads(fp.read())
+
+    except FileNotFoundError:
+
+        # Scrubber never ran
+
+        return {}
+
+class Scrubber:
+    """Re-verify stored media against their identifiers in the background.
+
+       The scrubber walks the MediaStore in identifier order, recomputes
+       the Whirlpool digest of each file, and records mismatches. Reads
+       are limited to Scrubber.rate bytes per second, so serving is not
+       starved. The state is saved in SCRUB_STATE_PATH after each file,
+       so a restarted scrubber resumes where it stopped.
+
+       Attributes:
+
+       Scrubber.media
+           The MediaStore instance to verify.
+
+       Scrubber.rate
+           Maximum number of bytes read per second.
+
+       Scrubber.state
+           A dict with the keys 'position' (last identifier verified in
+           the current pass), 'corrupt' (dict mapping corrupt identifiers
+           to the UNIX time they were found), 'verified' (files verified
+           in total), 'passes' (completed passes) and 'completed' (UNIX
+           time of the last completed pass).
+    """
+
+    def __init__(self, media, rate = SCRUB_RATE, interval = SCRUB_INTERVAL):
+        """Initialise, and read the state of an earlier run if present.
+           interval is the pause in seconds between two passes.
+        """
+
+        self.media = media
+
+        self.rate = rate
+
+        self.interval = interval
+
+        self.state = {"position": "",
+                      "corrupt": {},
+                      "verified": 0,
+                      "passes": 0,
+                      "completed": 0}
+
+        try:
+            with open(SCRUB_STATE_PATH, "rt", encoding="utf8") as fp:
+
+                self.state.update(json.loads(fp.read()))
+
+        except FileNotFoundError:
+
+            # First run
+
+            pass
+
+        self.thread = None
+
+        self.stopping = threading.Event()
+
+        set_metric("scrub_corrupt_files", len(self.state["corrupt"]))
+
+        return
+
+    def save(self):
+        """Write the state to SCRUB_STATE_PATH.
+        """
+
+        with open(SCRUB_STATE_PATH + ".tmp", "wt", encoding="utf8") as fp:
+
+            fp.write(json.dumps(self.state, sort_keys=True, indent=4) + "\n")
+
+        os.replace(SCRUB_STATE_PATH + ".tmp", SCRUB_STATE_PATH)
+
+        return
+
+    def verify(self, identifier):
+        """Recompute the digest of the file stored for identifier, and record the result.
+           Return True if the content matches the identifier.
+        """
+
+        try:
+            with self.media.open(identifier) as fp:
+
+                valid = whirlpool_digest(fp, self.rate) == identifier
+
+                count_metric("scrub_bytes", fp.tell())
+
+        except FileNotFoundError as error:
+
+            if identifier not in self.media:
+
+                # Removed since the pass started
+
+                return True
+
+            # The file is listed, but part of it is missing, e.g. a
+            # chunk of a ChunkedMediaStore file
+            #
+            LOGGER.error("Missing part of '{0}': {1}".format(identifier, error))
+
+            valid = False
+
+        if valid:
+
+            self.state["corrupt"].pop(identifier, None)
+
+        else:
+            LOGGER.error("Stored content does not match identifier '{0}'".format(identifier))
+
+            self.state["corrupt"][identifier] = time.time()
+
+        self.state["verified"] += 1
+
+        count_metric("scrub_files")
+
+        set_metric("scrub_corrupt_files", len(self.state["corrupt"]))
+
+        return valid
+
+    def scrub(self):
+        """Verify all files after the saved position, saving the state after each.
+           Return False if stopped before the pass was completed.
+        """
+
+        for identifier in self.media.identifiers():
+
+            if self.stopping.is_set():
+
+                return False
+
+            if identifier <= self.state["position"]:
+
+                continue
+
+            self.verify(identifier)
+
+            self.state["position"] = identifier
+
+            self.save()
+
+        self.state["position"] = ""
+
+        self.state["passes"] += 1
+
+        self.state["completed"] = time.time()
+
+        self.save()
+
+        return True
+
+    def run(self):
+        """Scrub repeatedly until Scrubber.stop() is called.
+        """
+
+        LOGGER.info("Scrubbing '{0}' at {1} bytes/s".format(self.media.path, self.rate))
+
+        while not self.stopping.is_set():
+
+            if self.scrub():
+
+                self.stopping.wait(self.interval)
+
+        return
+
+    def start(self):
+        """Start scrubbing in a daemon thread.
+        """
+
+        self.stopping.clear()
+
+        self.thread = threading.Thread(target=self.run, name="Scrubber", daemon=True)
+
+        self.thread.start()
+
+        return
+
+    def stop(self):
+        """Stop scrubbing after the current file.
+        """
+
+        self.stopping.set()
+
+        return
+
+def derivative_kind(format):
+    """Return the kind of derivative made for media of the given format, or None.
+       Kinds are 'thumbnail' for raster images, 'raster' for SVG, and
+       'excerpt' for text. Kinds needing an unavailable optional package
+       are not made.
+    """
+
+    format = format.split(";")[0].strip().lower()
+
+    if format in ("image/svg", "image/svg+xml"):
+
+        if cairosvg is None:
+
+            return None
+
+        return "raster"
+
+    if format.startswith("image/"):
+
+        if PIL is None:
+
+            return None
+
+        return "thumbnail"
+
+    if format.startswith("text/"):
+
+        return "excerpt"
+
+    return None
+
+def render_derivative(kind, source, filename):
+    """Render the derivative of bytes source, and write it to filename.
+       Runs in a worker process of DerivativeCache, except for excerpts.
+       Return the size of the written file.
+    """
+
+    temporary_path = "{0}.{1}.tmp".format(filename, os.getpid())
+
+    if kind == "excerpt":
+
+        with open(temporary_path, "wt", encoding="utf8") as fp:
+
+            fp.write(source.decode("utf8", errors="replace")[:EXCERPT_LENGTH])
+
+    else:
+        if kind == "raster":
+
+            source = cairosvg.svg2png(bytestring=source, output_width=THUMBNAIL_SIZE[0])
+
+        image = PIL.Image.open(io.BytesIO(source))
+
+        image.thumbnail(THUMBNAIL_SIZE)
+
+        if image.mode not in ("RGB", "RGBA", "L", "LA"):
+
+            image = image.convert("RGBA")
+
+        image.save(temporary_path, "PNG")
+
+    os.replace(temporary_path, filename)
+
+    return os.path.getsize(filename)
+
+class DerivativeCache:
+    """Previews of stored media, made lazily and cached on disk.
+
+       Images are rendered in a process pool, text excerpts are cut in
+       the requesting thread. Derivatives are stored as DerivativeCache.path/<first two characters>/<name>,
+       where name is the SHA-256 digest of the identifier, the kind of
+       derivative and its settings. Concurrent requests for a derivative
+       that is being made wait for the same result. When the cache
+       exceeds its budget, least recently used derivatives are removed.
+
+       Attributes:
+
+       DerivativeCache.media
+           The MediaStore holding the source files.
+
+       DerivativeCache.path
+           The cache directory.
+
+       DerivativeCache.budget
+           Maximum total size of the cache in bytes.
+
+       DerivativeCache.processes
+           Number of worker processes, None for one per CPU.
+
+       DerivativeCache.size
+           Total size of the cached derivatives in bytes.
+
+       DerivativeCache.pending
+           A dict mapping cache file names to a concurrent.futures.Future
+           of derivatives being made.
+
+       DerivativeCache.oversized
+           A set of cache file names whose sources are too large to render.
+    """
+
+    def __init__(self, media, path = DERIVATIVE_PATH, budget = DERIVATIVE_BUDGET, processes = None):
+        """Initialise, and total the size of the cached derivatives.
+        """
+
+        self.media = media
+
+        self.path = path
+
+        self.budget = budget
+
+        self.processes = processes
+
+        self.lock = threading.Lock()
+
+        self.pending = {}
+
+        self.oversized = set()
+
+        self.executor = None
+
+        self.size = 0
+
+        for filename in glob.glob(os.path.join(self.path, "*", "*")):
+
+            self.size += os.path.getsize(filename)
+
+        set_metric("derivative_cache_bytes", self.size)
+
+        return
+
+    def filename(self, identifier, kind):
+        """Return the cache path of the derivative of kind for identifier.
+        """
+
+        name = hashlib.sha256("{0}:{1}:{2}x{3}:{4}".format(identifier,
+                                                            kind,
+                                                            THUMBNAIL_SIZE[0],
+                                                            THUMBNAIL_SIZE[1],
+                                                            EXCERPT_LENGTH).encode("utf8")).hexdigest()
+
+        return os.path.join(self.path, name[:2], name + DERIVATIVE_EXTENSIONS[kind])
+
+    def get(self, identifier, format):
+        """Return the path of the derivative of the media stored for identifier, or None.
+           format is the format of the item. The derivative is made on
+           first request.
+        """
+
+        kind = derivative_kind(format)
+
+        if kind is None or identifier not in self.media:
+
+            return None
+
+        filename = self.filename(identifier, kind)
+
+        if os.path.exists(filename):
+
+            # Mark as recently used
+            #
+            os.utime(filename)
+
+            count_metric("derivative_hits")
+
+            return filename
+
+        if filename in self.oversized:
+
+            return None
+
+        with self.lock:
+
+            future = self.pending.get(filename)
+
+            making = future is None
+
+            if making:
+
+                future = concurrent.futures.Future()
+
+                self.pending[filename] = future
+
+        if not making:
+
+            count_metric("derivative_coalesced")
+
+            return future.result()
+
+        count_metric("derivative_misses")
+
+        try:
+            future.set_result(self.make(identifier, kind, filename))
+
+        except Exception as error:
+
+            LOGGER.warning("Can not make {0} of {1}: {2}".format(kind, identifier, error))
+
+            future.set_result(None)
+
+        finally:
+            with self.lock:
+
+                del self.pending[filename]
+
+        return future.result()
+
+    def make(self, identifier, kind, filename):
+        """Make the derivative of kind for identifier, and return filename.
+           Images are rendered in the process pool, text excerpts in the
+           calling thread. Return None if the source is too large.
+        """
+
+        limit = DERIVATIVE_SOURCE_LIMIT
+
+        if kind == "excerpt":
+
+            # At most four bytes per character in UTF-8
+            #
+            limit = EXCERPT_LENGTH * 4
+
+        if kind != "excerpt" and self.media.size(identifier) > limit:
+
+            # Remember, so the size is not looked up on every request
+            #
+            self.oversized.add(filename)
+
+            return None
+
+        source = b""
+
+        with self.media.open(identifier) as fp:
+
+            # Media file objects may return less than asked for
+            #
+            block = fp.read(limit)
+
+            while block and len(source) < limit:
+
+                source += block
+
+                block = fp.read(limit - len(source))
+
+        source = source[:limit]
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        if kind == "excerpt":
+
+            # Cutting a few kB of text is cheaper than a worker process
+            #
+            size = render_derivative(kind, source, filename)
+
+        else:
+            with self.lock:
+
+                if self.executor is None:
+
+                    # Forking a threaded server is unsafe, start fresh interpreters
+                    #
+                    self.executor = concurrent.futures.ProcessPoolExecutor(self.processes,
+                                                                           mp_context=multiprocessing.get_context("spawn"))
+
+                executor = self.executor
+
+            size = executor.submit(render_derivative, kind, source, filename).result()
+
+        with self.lock:
+
+            self.size += size
+
+            if self.size > self.budget:
+
+                self.evict()
+
+            set_metric("derivative_cache_bytes", self.size)
+
+        return filename
+
+    def evict(self):
+        """Remove least recently used derivatives until the cache fits its budget.
+           Must be called with DerivativeCache.lock held.
+        """
+
+        files = []
+
+        self.size = 0
+
+        for filename in glob.glob(os.path.join(self.path, "*", "*")):
+
+            try:
+                stat = os.stat(filename)
+
+            except FileNotFoundError:
+
+                # Removed by another process
+                #
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, filename))
+
+            self.size += stat.st_size
+
+        files.sort()
+
+        while self.size > self.budget and files:
+
+            mtime, size, filename = files.pop(0)
+
+            try:
+                os.remove(filename)
+
+            except FileNotFoundError:
+
+                pass
+
+            self.size -= size
+
+            count_metric("derivative_evictions")
+
+        return
+
+    def stop(self):
+        """Shut down the worker processes.
+        """
+
+        with self.lock:
+
+            executor = self.executor
+
+            self.executor = None
+
+        if executor is not None:
+
+            executor.shutdown()
+
+        return
+
+def derivative_cache(config):
+    """Return the DerivativeCache configured in the [derivatives] section of config, or None if disabled.
+    """
+
+    if not config.getboolean("derivatives", "enabled", fallback=True):
+
+        return None
+
+    return DerivativeCache(media_store(config),
+                           config.get("derivatives", "path", fallback=DERIVATIVE_PATH),
+                           config.getint("derivatives", "budget", fallback=DERIVATIVE_BUDGET),
+                           config.getint("derivatives", "processes", fallback=0) or None)
+
+def add_archive_member(archive, name, fp, size):
+    """Stream size bytes from the binary file fp into the tarfile.TarFile archive as name.
+    """
+
+    info = tarfile.TarInfo(name)
+
+    info.size = size
+
+    info.mtime = int(time.time())
+
+    info.mode = 0o644
+
+    archive.addfile(info, fp)
+
+    return
+
+def export_archive(fp, repository, media = None, compression = ""):
+    """Write repository as a tar archive to the binary file fp, and return the number of items.
+       The archive holds a header, accounts.txt from CWD if present,
+       and per item in the order of addition the stored media file
+       from MediaStore media, if present, followed by the item as JSON.
+       The archive is streamed, so fp need not be seekable.
+       compression is "" or "gz".
+    """
+
+    count = 0
+
+    with tarfile.open(fileobj=fp, mode="w|" + compression) as archive:
+
+        header = json.dumps({"format": ARCHIVE_FORMAT,
+                             "items": len(repository.items)}).encode("utf8")
+
+        add_archive_member(archive, ARCHIVE_HEADER, io.BytesIO(header), len(header))
+
+        if os.path.isfile("accounts.txt"):
+
+            archive.add("accounts.txt", arcname="accounts.txt")
+
+        # Replaced items appear more than once in the change order
+        #
+        for identifier in dict.fromkeys(list(repository.changes)).keys():
+
+            if media is not None and identifier in media:
+
+                with media.open(identifier) as media_fp:
+
+                    add_archive_member(archive, "media/" + identifier, media_fp, media.size(identifier))
+
+            record = json.dumps(item_as_dict(repository.items[identifier]), sort_keys=True).encode("utf8")
+
+            add_archive_member(archive, "items/{0}.json".format(identifier), io.BytesIO(record), len(record))
+
+            count += 1
+
+    return count
+
+def verify_and_store(media, identifier, temporary_path):
+    """Store the file temporary_path in MediaStore media if its Whirlpool digest is identifier.
+       The file is removed. Return True if it was stored.
+       Runs in a worker thread of import_archive().
+    """
+
+    try:
+        with open(temporary_path, "rb") as fp:
+
+            if whirlpool_digest(fp) != identifier:
+
+                return False
+
+            fp.seek(0)
+
+            media.store(fp)
+
+    finally:
+        os.remove(temporary_path)
+
+    return True
+
+def import_archive(fp, repository, media = None, workers = None, commit_interval = IMPORT_COMMIT_INTERVAL):
+    """Add the items, accounts and media in the tar archive read from the binary file fp.
+       Items already in repository and media already in MediaStore
+       media are skipped, so an interrupted import is resumed by running
+       it again. Media files are verified against their identifiers by
+       workers threads in parallel, and an item with media in the
+       archive is only added if they match. The repository is dumped
+       every commit_interval added items, and at the end.
+       Return a dict of counts.
+    """
+
+    report = {"items_added": 0,
+              "items_present": 0,
+              "items_invalid": 0,
+              "media_stored": 0,
+              "media_present": 0,
+              "media_corrupt": 0,
+              "accounts_added": 0}
+
+    # Verifications in progress, oldest first, and the items waiting for them
+    #
+    pending = {}
+
+    waiting = {}
+
+    corrupt = set()
+
+    def add(item):
+
+        try:
+            repository.add(item)
+
+        except RuntimeError:
+
+            report["items_invalid"] += 1
+
+            return
+
+        report["items_added"] += 1
+
+        if not report["items_added"] % commit_interval:
+
+            repository.dump()
+
+        return
+
+    def settle(identifier):
+
+        if pending.pop(identifier).result():
+
+            report["media_stored"] += 1
+
+        else:
+            report["media_corrupt"] += 1
+
+            corrupt.add(identifier)
+
+        if identifier in waiting:
+
+            if identifier in corrupt:
+
+                report["items_invalid"] += 1
+
+                del waiting[identifier]
+
+            else:
+                add(waiting.pop(identifier))
+
+        return
+
+    workers = workers or os.cpu_count() or 1
+
+    spooled = 0
+
+    # Keep what was added if the archive turns out to be truncated
+    #
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor, tarfile.open(fileobj=fp, mode="r|*") as archive:
+
+            members = iter(archive)
+
+            header = next(members, None)
+
+            if header is None or header.name != ARCHIVE_HEADER:
+
+                raise ValueError("Not an OpenMediaRepository archive")
+
+            for member in members:
+
+                directory, slash, name = member.name.partition("/")
+
+                if not member.isfile():
+
+                    continue
+
+                if member.name == "accounts.txt":
+
+                    accounts = Accounts()
+
+                    try:
+                        accounts.load()
+
+                    except FileNotFoundError:
+
+                        # File will be created below
+                        #
+                        pass
+
+                    for line in archive.extractfile(member).read().decode("utf8").splitlines():
+
+                        if line.strip():
+
+                            try:
+                                accounts.add(line)
+
+                            except ValueError:
+
+                                # Already present
+                                #
+                                continue
+
+                            report["accounts_added"] += 1
+
+                    accounts.dump()
+
+                elif directory == "media" and media is not None:
+
+                    if not valid_identifier(name):
+
+                        report["media_corrupt"] += 1
+
+                        continue
+
+                    if name in media or name in pending:
+
+                        report["media_present"] += 1
+
+                        continue
+
+                    # Spool the file, so the archive can be read on while
+                    # a worker verifies it
+                    #
+                    os.makedirs(media.path, exist_ok=True)
+
+                    temporary_path = os.path.join(media.path, "import.{0}.{1}.tmp".format(os.getpid(), spooled))
+
+                    spooled += 1
+
+                    member_fp = archive.extractfile(member)
+
+                    with open(temporary_path, "wb") as temporary_fp:
+
+                        block = member_fp.read(BLOCK_SIZE)
+
+                        while block:
+
+                            temporary_fp.write(block)
+
+                            block = member_fp.read(BLOCK_SIZE)
+
+                    pending[name] = executor.submit(verify_and_store, media, name, temporary_path)
+
+                    # Bound the spooled files
+                    #
+                    while len(pending) >= workers * IMPORT_PENDING_PER_WORKER:
+
+                        settle(next(iter(pending.keys())))
+
+                elif directory == "items" and name.endswith(".json"):
+
+                    item = json.loads(archive.extractfile(member).read().decode("utf8"))
+
+                    identifier = item.get("identifier")
+
+                    if identifier in repository.items:
+
+                        report["items_present"] += 1
+
+                    elif not valid_identifier(identifier) or identifier in corrupt:
+
+                        report["items_invalid"] += 1
+
+                    elif identifier in pending:
+
+                        waiting[identifier] = item
+
+                    else:
+                        add(item)
+
+            while pending:
+
+                settle(next(iter(pending.keys())))
+
+    finally:
+        if report["items_added"]:
+
+            repository.dump()
+
+    return report
+
+class Follower:
+    """Replicate the items of a leader repository instance.
+
+       The follower tails the change feed of the leader at
+       /changes?since=N, and applies the items added there through
+       Repository.add(). The last applied sequence number is stored in
+       FOLLOWER_STATE_PATH, so replication resumes after a restart.
+
+       Attributes:
+
+       Follower.leader
+           Base URI of the leader, e.g. 'http://leader.domain:8006'.
+
+       Follower.repository
+           The local Repository instance.
+
+       Follower.state
+           A dict with the keys 'leader', 'sequence' (last applied
+           sequence number of the leader), 'leader_sequence' (latest
+           sequence number seen at the leader) and 'updated' (UNIX time
+           of the last successful poll).
+    """
+
+    def __init__(self, leader, repository, timeout = LONG_POLL_TIMEOUT):
+        """Initialise, and read the state of an earlier run if present.
+           timeout is the long-poll timeout in seconds.
+        """
+
+        self.leader = leader.rstrip("/")
+
+        self.repository = repository
+
+        self.timeout = timeout
+
+        self.state = read_follower_state()
+
+        if self.state.get("leader") != self.leader:
+
+            # Different or no leader before, start from scratch.
+            # Items already present are skipped while catching up.
+            #
+            self.state = {"leader": self.leader,
+                          "sequence": 0,
+                          "leader_sequence": 0,
+                          "updated": 0}
+
+        self.thread = None
+
+        self.stopping = threading.Event()
+
+        return
+
+    def poll(self):
+        """Fetch and apply one batch of changes from the leader.
+           Return the number of items added.
+        """
+
+        uri = "{0}/changes?{1}".format(self.leader,
+                                       urllib.parse.urlencode({"since": self.state["sequence"],
+                                                               "timeout": self.timeout}))
+
+        with urllib.request.urlopen(uri, timeout=self.timeout + 10) as response:
+
+            feed = json.loads(response.read().decode("utf8"))
+
+        if feed.get("recorded", feed["sequence"]) < self.state["sequence"]:
+
+            LOGGER.warning("Leader sequence {0} is behind follower sequence {1}, starting over".format(feed["sequence"], self.state["sequence"]))
+
+            self.state["sequence"] = 0
+
+            return 0
+
+        added = 0
+
+        for change in feed["changes"]:
+
+            if change["identifier"] not in self.repository.items:
+
+                self.repository.add(change["item"])
+
+                added += 1
+
+        if added:
+
+            self.repository.dump()
+
+        if feed["changes"]:
+
+            self.state["sequence"] = feed["changes"][-1]["sequence"]
+
+        self.state["leader_sequence"] = feed["sequence"]
+
+        self.state["updated"] = time.time()
+
+        write_follower_state(self.state)
+
+        return added
+
+    def run(self):
+        """Poll the leader until Follower.stop() is called.
+        """
+
+        LOGGER.info("Following {0} from sequence {1}".format(self.leader, self.state["sequence"]))
+
+        while not self.stopping.is_set():
+
+            try:
+                self.poll()
+
+            except (OSError, ValueError, KeyError) as error:
+
+                LOGGER.warning("Polling {0} failed: {1}".format(self.leader, error))
+
+                self.stopping.wait(FOLLOWER_RETRY_INTERVAL)
+
+        return
+
+    def start(self):
+        """Start following in a daemon thread.
+        """
+
+        self.stopping.clear()
+
+        self.thread = threading.Thread(target=self.run, name="Follower", daemon=True)
+
+        self.thread.start()
+
+        return
+
+    def stop(self):
+        """Stop following after the current poll.
+        """
+
+        self.stopping.set()
+
+        return
+
+def read_follower_state():
+    """Return the follower state stored in FOLLOWER_STATE_PATH, or an empty dict.
+    """
+
+    try:
+        with open(FOLLOWER_STATE_PATH, "rt", encoding="utf8") as fp:
+
+            return json.loads(fp.read())
+
+    except FileNotFoundError:
+
+        return {}
+
+def write_follower_state(state):
+    """Store the follower state in FOLLOWER_STATE_PATH.
+    """
+
+    with open(FOLLOWER_STATE_PATH + ".tmp", "wt", encoding="utf8") as fp:
+
+        fp.write(json.dumps(state, sort_keys=True, indent=4) + "\n")
+
+    os.replace(FOLLOWER_STATE_PATH + ".tmp", FOLLOWER_STATE_PATH)
+
+    return
+
+def replication_status():
+    """Return a dict describing the replication lag of this instance.
+       Empty if this instance is not a follower.
+    """
+
+    state = read_follower_state()
+
+    if not state:
+
+        return {}
+
+    return {"leader": state["leader"],
+            "sequence": state["sequence"],
+            "leader_sequence": state["leader_sequence"],
+            "lag_changes": max(state["leader_sequence"] - state["sequence"], 0),
+            "seconds_since_poll": round(time.time() - state["updated"], 3) if state["updated"] else None}
+
+class AdmissionControl:
+    """Limit concurrent requests per route class, and shed load early.
+
+       Requests are sorted into route classes by route_class(). Each
+       class has its own limit, so expensive listing renders can not
+       take the threads needed for cheap item pages. Only a bounded
+       number of requests may wait for a slot, since each of them holds
+       a server thread. A request that finds the queue full, or that can
+       not get a slot within AdmissionControl.queue_timeout seconds, is
+       answered with 503 and a Retry-After header.
+
+       Attributes:
+
+       AdmissionControl.limits
+           A dict mapping route class names to the maximum number of
+           concurrent requests.
+
+       AdmissionControl.queues
+           A dict mapping route class names to the maximum number of
+           requests waiting for a slot.
+
+       AdmissionControl.slots
+           A dict mapping route class names to threading.BoundedSemaphore
+           instances for running requests.
+
+       AdmissionControl.admitted
+           A dict mapping route class names to threading.BoundedSemaphore
+           instances for running and waiting requests.
+
+       AdmissionControl.queue_timeout
+           Seconds to wait for a slot before rejecting.
+
+       AdmissionControl.retry_after
+           Value of the Retry-After header of rejections, in seconds.
+    """
+
+    def __init__(self, limits = ADMISSION_LIMITS, queues = ADMISSION_QUEUES, queue_timeout = ADMISSION_QUEUE_TIMEOUT, retry_after = ADMISSION_RETRY_AFTER):
+        """Initialise.
+        """
+
+        self.limits = dict(limits)
+
+        self.queues = dict(queues)
+
+        self.slots = dict([(name, threading.BoundedSemaphore(self.limits[name])) for name in self.limits.keys()])
+
+        self.admitted = dict([(name, threading.BoundedSemaphore(self.limits[name] + self.queues[name])) for name in self.limits.keys()])
+
+        self.queue_timeout = queue_timeout
+
+        self.retry_after = retry_after
+
+        return
+
+    def acquire(self, name):
+        """Wait for a slot of route class name.
+           Return True if one was acquired.
+        """
+
+        if self.admitted[name].acquire(blocking=False):
+
+            if self.slots[name].acquire(timeout=self.queue_timeout):
+
+                return True
+
+            self.admitted[name].release()
+
+        count_metric("admission_rejected_" + name)
+
+        return False
+
+    def release(self, name):
+        """Give back a slot of route class name.
+        """
+
+        self.slots[name].release()
+
+        self.admitted[name].release()
+
+        return
+
+def route_class(path, method):
+    """Return the name of the admission route class for a request.
+    """
+
+    path = path.rstrip("/")
+
+    if path == "/items":
+
+        if method == "POST":
+
+            return "write"
+
+        return "listing"
+
+    if path == "/items/sync":
+
+        return "listing"
+
+    if path == "/items/batch":
+
+        return "write"
+
+    if path == "/changes":
+
+        return "feed"
+
+    # Drill-downs scan all items, the profiler summary merges stats files
+    #
+    if path.startswith("/items/facet/") or path == "/profiler":
+
+        return "listing"
+
+    if path.startswith("/items/derivative/"):
+
+        return "listing"
+
+    return "cheap"
+
+def admit(control):
+    """CherryPy tool callable, run before the page handler.
+       Rejects the request with 503 if control has no slot for it.
+    """
+
+    request = cherrypy.serving.request
+
+    name = route_class(request.path_info, request.method)
+
+    if not control.acquire(name):
+
+        response = cherrypy.serving.response
+
+        response.status = 503
+
+        response.headers["Retry-After"] = str(control.retry_after)
+
+        response.headers["Content-Type"] = "text/plain;charset=utf-8"
+
+        response.body = b"Server busy, please retry.\n"
+
+        # Skip the page handler
+        #
+        request.handler = None
+
+        return
+
+    request.hooks.attach("on_end_request", control.release, name=name)
+
+    return
+
+cherrypy.tools.admission = cherrypy.Tool("on_start_resource", admit)
+
+class Profiler:
+    """Profile a sample of requests with cProfile, and keep the slow ones.
+
+       When disabled, main() does not install the CherryPy tool unless
+       the profiler is changeable, and otherwise a request costs one
+       attribute lookup. When enabled,
+       a request is profiled with probability Profiler.sample, or always
+       if Profiler.threshold is set; in the latter case, stats are only
+       kept for requests that took at least threshold seconds. Stats
+       files are written to Profiler.path, keeping the newest
+       Profiler.keep files.
+
+       Attributes:
+
+       Profiler.enabled
+           True if requests are profiled.
+
+       Profiler.sample
+           Fraction of requests to profile, between 0 and 1.
+
+       Profiler.threshold
+           Minimum duration in seconds of requests to keep stats for,
+           or 0 to keep all sampled requests.
+
+       Profiler.path
+           Directory for stats files.
+
+       Profiler.keep
+           Maximum number of stats files kept.
+
+       Profiler.changeable
+           True if the settings may be changed at runtime via /profiler.
+    """
+
+    def __init__(self, enabled = False, sample = PROFILE_SAMPLE, threshold = 0, path = PROFILE_PATH, keep = PROFILE_KEEP, changeable = False):
+        """Initialise.
+        """
+
+        self.enabled = enabled
+
+        self.sample = sample
+
+        self.threshold = threshold
+
+        self.path = path
+
+        self.keep = keep
+
+        self.changeable = changeable
+
+        return
+
+    def configure(self, config):
+        """Read settings from the [profiler] section of configparser.ConfigParser config.
+        """
+
+        self.enabled = config.getboolean("profiler", "enabled", fallback=self.enabled)
+
+        self.sample = config.getfloat("profiler", "sample", fallback=self.sample)
+
+        self.threshold = config.getfloat("profiler", "threshold", fallback=self.threshold)
+
+        self.path = config.get("profiler", "path", fallback=self.path)
+
+        self.keep = config.getint("profiler", "keep", fallback=self.keep)
+
+        self.changeable = config.getboolean("profiler", "changeable", fallback=self.changeable)
+
+        return
+
+    def start(self):
+        """Decide whether to profile the current request, and start profiling the current thread.
+           Return a tuple (cProfile.Profile instance, start time), or None.
+        """
+
+        if not self.enabled:
+
+            return None
+
+        if not self.threshold and random.random() >= self.sample:
+
+            return None
+
+        profile = cProfile.Profile()
+
+        try:
+            profile.enable()
+
+        except ValueError:
+
+            # Another profiler is active in this interpreter
+
+            return None
+
+        return (profile, time.monotonic())
+
+    def finish(self, started, label):
+        """Stop profiling, and write the stats if the request was slow enough.
+           started is the return value of Profiler.start().
+           label describes the request, e.g. 'GET /items'.
+        """
+
+        profile, start_time = started
+
+        profile.disable()
+
+        seconds = time.monotonic() - start_time
+
+        if seconds < self.threshold:
+
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+
+        slug = "".join([character if character.isalnum() else "_" for character in label])[:64]
+
+        filename = "{0}-{1}-{2}ms.prof".format(datetime.datetime.now().strftime("%Y%m%d%H%M%S%f"),
+                                                slug,
+                                                int(seconds * 1000))
+
+        profile.dump_stats(os.path.join(self.path, filename))
+
+        count_metric("profiles_written")
+
+        self.rotate()
+
+        return
+
+    def files(self):
+        """Return the stats files in Profiler.path, oldest first.
+        """
+
+        return sorted(glob.glob(os.path.join(self.path, "*.prof")))
+
+    def rotate(self):
+        """Remove the oldest stats files beyond Profiler.keep.
+        """
+
+        files = self.files()
+
+        for filename in files[:max(len(files) - self.keep, 0)]:
+
+            try:
+                os.remove(filename)
+
+            except FileNotFoundError:
+
+                # Removed by another thread
+
+                pass
+
+        return
+
+    def summary(self, limit = PROFILE_SUMMARY_LIMIT):
+        """Return the top limit functions by cumulative time over all kept stats files, as text.
+        """
+
+        files = self.files()
+
+        if not files:
+
+            return "No profiles recorded.\n"
+
+        output = io.StringIO()
+
+        stats = pstats.Stats(files[0], stream=output)
+
+        for filename in files[1:]:
+
+            try:
+                stats.add(filename)
+
+            except (FileNotFoundError, EOFError):
+
+                # Rotated away meanwhile
+
+                pass
+
+        stats.sort_stats("cumulative").print_stats(limit)
+
+        return output.getvalue()
+
+PROFILER = Profiler()
+
+def start_profile():
+    """CherryPy tool callable, run before the page handler.
+    """
+
+    started = PROFILER.start()
+
+    if started is not None:
+
+        request = cherrypy.serving.request
+
+        request.hooks.attach("on_end_resource",
+                             PROFILER.finish,
+                             started=started,
+                             label="{0} {1}".format(request.method, request.path_info))
+
+    return
+
+cherrypy.tools.sampling_profiler = cherrypy.Tool("on_start_resource", start_profile, priority=60)
+
+class SQLiteSession(cherrypy.lib.sessions.Session):
+    """CherryPy session storage in a SQLite database.
+
+       Use with tools.sessions.storage_class. Expired sessions are swept
+       by CherryPy's session cleanup thread every clean_freq minutes.
+       Locks are held per process; SQLite serialises the writes of
+       several processes.
+
+       Class attributes:
+
+       SQLiteSession.storage_path
+           Path to the SQLite database file.
+    """
+
+    storage_path = SESSION_SQLITE_PATH
+
+    # Session id -> threading.RLock
+    #
+    locks = {}
+
+    # One connection per thread, as sqlite3 connections can not be shared
+    #
+    connections = threading.local()
+
+    @classmethod
+    def setup(cls, **kwargs):
+        """Set up the database. Called by CherryPy once per process.
+        """
+
+        for key in kwargs.keys():
+
+            setattr(cls, key, kwargs[key])
+
+        connection = sqlite3.connect(cls.storage_path)
+
+        with connection:
+
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data BLOB, expiration REAL)")
+
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_expiration ON sessions (expiration)")
+
+        connection.close()
+
+        return
+
+    def connection(self):
+        """Return the database connection of the current thread.
+        """
+
+        connection = getattr(self.connections, "connection", None)
+
+        if connection is None:
+
+            connection = sqlite3.connect(self.storage_path, timeout=SESSION_SQLITE_TIMEOUT)
+
+            self.connections.connection = connection
+
+        return connection
+
+    def _exists(self):
+
+        row = self.connection().execute("SELECT 1 FROM sessions WHERE id = ? AND expiration >= ?",
+                                        (self.id, self.now().timestamp())).fetchone()
+
+        return row is not None
+
+    def _load(self):
+
+        row = self.connection().execute("SELECT data, expiration FROM sessions WHERE id = ?",
+                                        (self.id,)).fetchone()
+
+        if row is None:
+
+            return None
+
+        return (pickle.loads(row[0]), datetime.datetime.fromtimestamp(row[1]))
+
+    def _save(self, expiration_time):
+
+        connection = self.connection()
+
+        with connection:
+
+            connection.execute("INSERT OR REPLACE INTO sessions (id, data, expiration) VALUES (?, ?, ?)",
+                               (self.id, pickle.dumps(self._data, pickle.HIGHEST_PROTOCOL), expiration_time.timestamp()))
+
+        return
+
+    def _delete(self):
+
+        connection = self.connection()
+
+        with connection:
+
+            connection.execute("DELETE FROM sessions WHERE id = ?", (self.id,))
+
+        self.locks.pop(self.id, None)
+
+        return
+
+    def acquire_lock(self):
+        """Acquire an exclusive lock on the session data in this process.
+        """
+
+        self.locked = True
+
+        self.locks.setdefault(self.id, threading.RLock()).acquire()
+
+        return
+
+    def release_lock(self):
+        """Release the lock on the session data.
+        """
+
+        self.locks[self.id].release()
+
+        self.locked = False
+
+        return
+
+    def clean_up(self):
+        """Delete expired sessions.
+        """
+
+        connection = self.connection()
+
+        now = self.now().timestamp()
+
+        expired = [row[0] for row in connection.execute("SELECT id FROM sessions WHERE expiration < ?", (now,))]
+
+        with connection:
+
+            connection.execute("DELETE FROM sessions WHERE expiration < ?", (now,))
+
+        for identifier in expired:
+
+            self.locks.pop(identifier, None)
+
+        count_metric("sessions_expired", len(expired))
+
+        return
+
+    def __len__(self):
+        """Return the number of active sessions.
+        """
+
+        return self.connection().execute("SELECT COUNT(*) FROM sessions WHERE expiration >= ?",
+                                         (self.now().timestamp(),)).fetchone()[0]
+
+def session_config(config):
+    """Return CherryPy config entries for sessions, from the [sessions] section of config.
+       storage is 'file' (default), 'sqlite' or 'ram'.
+    """
+
+    storage = config.get("sessions", "storage", fallback="file")
+
+    session_dict = {"tools.sessions.on": True,
+                    "tools.sessions.timeout": config.getint("sessions", "timeout", fallback=SESSION_TIMEOUT),
+                    "tools.sessions.clean_freq": config.getint("sessions", "clean_freq", fallback=SESSION_CLEAN_FREQ)}
+
+    if storage == "file":
+
+        path = config.get("sessions", "path", fallback=SESSION_FILE_PATH)
+
+        os.makedirs(path, exist_ok=True)
+
+        session_dict["tools.sessions.storage_class"] = cherrypy.lib.sessions.FileSession
+
+        session_dict["tools.sessions.storage_path"] = path
+
+    elif storage == "sqlite":
+
+        session_dict["tools.sessions.storage_class"] = SQLiteSession
+
+        session_dict["tools.sessions.storage_path"] = config.get("sessions", "path", fallback=SESSION_SQLITE_PATH)
+
+    elif storage != "ram":
+
+        raise ValueError("Unknown session storage: '{0}'".format(storage))
+
+    return session_dict
+
+def session_routes(config):
+    """Return a dict mapping the routes listed in [sessions] routes of config to their session_config().
+       Without routes, sessions are off.
+    """
+
+    routes = {}
+
+    for route in config.get("sessions", "routes", fallback="").split(","):
+
+        if route.strip():
+
+            routes[route.strip()] = session_config(config)
+
+    return routes
+
+class ItemsWebApp:
+    """HTTP-REST-Interface to the Repository class, to be mounted in the CherryPy root.
+
+       Attributes:
+
+       ItemsWebApp.webapp
+           The WebApp instance that this ItemsWebApp instance is attached to.
+    """
+
+    # It is not feasible to expose Repository directly.
+    # OOP uses verbs, while REST is supposed to use nouns.
+
+    def __init__(self, webapp):
+        """Initialise ItemsWebApp.
+           webapp is the WebApp instance that this ItemsWebApp instance is attached to.
+        """
+
+        self.webapp = webapp
+
+        return
+
+    def __call__(self, *args, **kwargs):
+        """List items, or add a given item.
+           Called by cherrypy.
+           HTTP GET calls will submit args.
+           HTTP POST calls will submit kwargs.
+        """
+
+        # NOTE: Multiple exit points ahead.
+        
+        page = simple.html.Page("Item", css=self.webapp.css)
+        
+        page.append(self.webapp.config["startpage"]["header"])
+
+        if args:
+
+            if args[0] not in self.webapp.repository.items.keys():
+
+                # TODO: Return error code
+                #
+                page.append("<p>Error: item does not exist</p>")
+
+                page.append(self.webapp.config["startpage"]["footer"])
+                
+                return str(page)
+
+            page.append('<ul><li><a href="/">Home</a></li><li><a href="/items">Items</a></li></ul>')
+
+            # Look the item up once, lookups in a shared snapshot decode
+            # the record every time
+            #
+            item = self.webapp.repository.items[args[0]]
+        
+            # TODO: Item rendering should be done by a special method
+            #
+            page.append("<h1>{0}</h1>".format(item.title))
+
+            page.append("<ul>")
+
+            for dc_key in DUBLIN_CORE_PROPERTIES.keys():
+
+                if dc_key != "title":
+
+                    page.append("<li>{0}: {1}</li>".format(dc_key.capitalize(), item.__getattr__(dc_key)))
+
+            page.append("</ul>")
+
+            self.append_derivative(page, args[0], item)
+
+            page.append(self.webapp.config["startpage"]["footer"])
+            
+            return str(page)
+
+        # No args.
+
+        page = simple.html.Page("Items", css=self.webapp.css)
+
+        page.append(self.webapp.config["startpage"]["header"])
+
+        if len(kwargs):
+
+            if not valid_identifier(kwargs.get("identifier")):
+
+                # TODO: Return error code
+                #
+                page.append("<p>Error: invalid identifier</p>")
+
+                page.append(self.webapp.config["startpage"]["footer"])
+                
+                return str(page)
+
+            if kwargs["identifier"] in self.webapp.repository.items.keys():
+
+                # TODO: Return error code
+                #
+                page.append("<p>Error: identifier already exists</p>")
+
+                page.append(self.webapp.config["startpage"]["footer"])
+                
+                return str(page)
+
+            self.webapp.repository.add(item_dict_from(kwargs))
+
+            # Be persistent
+            #
+            self.webapp.snapshots.request()
+
+            page.append("<h1>Item added</h1>")
+
+            page.append('<p><a href="/items/{0}">View item</a></p>'.format(kwargs["identifier"]))
+
+            page.append(self.webapp.config["startpage"]["footer"])
+            
+            return str(page)
+
+        # No kwargs either.
+
+        page.append('<ul><li><a href="/">Home</a></li></ul>')
+        
+        page.append("<h1>Items</h1>")
+
+        self.append_facets(page)
+
+        # Copy the items, other threads may add items meanwhile
+        #
+        self.append_items(page, list(self.webapp.repository.items.items()))
+
+        page.append(self.webapp.config["startpage"]["footer"])
+        
+        return str(page)
+
+    def append_items(self, page, items):
+        """Append a list of items to page.
+           items is a list of (identifier, Item) tuples.
+        """
+
+        page.append("<ul>")
+        
+        for identifier, item in items:
+
+            page.append('<li><a href="/items/{0}">{1}</a>'.format(identifier, item.title))
+
+            page.append("<ul>")
+            
             for dc_key in DUBLIN_CORE_PROPERTIES.keys():
 
-                if dc_key != "title":
+                if dc_key != "title":
+
+                    page.append("<li>{0}: {1}</li>".format(dc_key.capitalize(), item.__getattr__(dc_key)))
+
+            page.append("</ul>")        
+
+            page.append("</li>")
+
+        page.append("</ul>")
+
+        return
+
+    def append_derivative(self, page, identifier, item):
+        """Append a preview of the media stored for identifier to page, if there is one.
+           item is the Item for identifier.
+           Images are linked to /items/derivative/<identifier>, text
+           excerpts are included.
+        """
+
+        derivatives = self.webapp.derivatives
+
+        if derivatives is None or identifier not in derivatives.media:
+
+            return
+
+        format = item.format
+
+        kind = derivative_kind(format)
+
+        if kind in ("thumbnail", "raster"):
+
+            page.append('<p><img src="/items/derivative/{0}" alt="Preview"></p>'.format(identifier))
+
+        elif kind == "excerpt":
+
+            filename = derivatives.get(identifier, format)
+
+            if filename is not None:
+
+                with open(filename, "rt", encoding="utf8") as fp:
+
+                    page.append("<pre>{0}</pre>".format(html.escape(fp.read())))
+
+        return
+
+    def derivative(self, identifier):
+        """Return the preview of the media stored for an item, made on first request.
+           URI: /items/derivative/<identifier>
+        """
+
+        derivatives = self.webapp.derivatives
+
+        if derivatives is None or identifier not in self.webapp.repository.items.keys():
+
+            raise cherrypy.HTTPError(404, "No such item")
+
+        format = self.webapp.repository.items[identifier].format
+
+        filename = derivatives.get(identifier, format)
+
+        if filename is None:
+
+            raise cherrypy.HTTPError(404, "No preview available")
+
+        with open(filename, "rb") as fp:
+
+            body = fp.read()
+
+        if derivative_kind(format) == "excerpt":
+
+            cherrypy.response.headers["Content-Type"] = "text/plain;charset=utf-8"
+
+        else:
+            cherrypy.response.headers["Content-Type"] = "image/png"
+
+        # Identifiers are content hashes, so previews never change
+        #
+        cherrypy.response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+
+        return body
+
+    derivative.exposed = True
+
+    def append_facets(self, page):
+        """Append the facet counts to page, linking to the items of each value.
+        """
+
+        facet_counts = self.webapp.repository.facet_counts()
+
+        page.append("<dl>")
+
+        for facet in FACETS:
+
+            if not facet_counts[facet]:
+
+                continue
+
+            page.append("<dt>{0}</dt><dd><ul>".format(facet.capitalize()))
+
+            for value, count in sorted(facet_counts[facet].items(), key=lambda value_count: (-value_count[1], value_count[0])):
+
+                page.append('<li><a href="/items/facet/{0}/{1}">{2}</a> ({3})</li>'.format(facet,
+                                                                                         urllib.parse.quote(value, safe=""),
+                                                                                         html.escape(value),
+                                                                                         count))
+
+            page.append("</ul></dd>")
+
+        page.append("</dl>")
+
+        return
+
+    def facet(self, name, *value):
+        """List the items with value for facet name.
+           URI: /items/facet/(name)/(value)
+        """
+
+        # Values may contain slashes, e.g. formats
+        #
+        value = "/".join(value)
+
+        if name not in FACETS:
+
+            raise cherrypy.HTTPError(404, "No such facet: '{0}'".format(name))
+
+        repository = self.webapp.repository
+
+        items = [(identifier, item) for identifier, item in list(repository.items.items())
+                 if (name, value) in item_facets(item)]
+
+        page = simple.html.Page("Items", css=self.webapp.css)
+
+        page.append(self.webapp.config["startpage"]["header"])
+
+        page.append('<ul><li><a href="/">Home</a></li><li><a href="/items">Items</a></li></ul>')
+
+        page.append("<h1>{0}: {1} ({2})</h1>".format(name.capitalize(), html.escape(value), len(items)))
+
+        self.append_items(page, items)
+
+        page.append(self.webapp.config["startpage"]["footer"])
+
+        return str(page)
+
+    facet.exposed = True
+
+    def facets(self):
+        """Return the facet counts as JSON.
+           URI: /items/facets
+        """
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(self.webapp.repository.facet_counts(), sort_keys=True).encode("utf8")
+
+    facets.exposed = True
+
+    def add(self):
+
+        page = simple.html.Page("Add Item", css=self.webapp.css)
+
+        page.append(self.webapp.config["startpage"]["header"])
+
+        page.append('<ul><li><a href="/">Home</a></li></ul>')
+        
+        page.append("<h1>Add item</h1>")
+
+        page.append("<dl>")
+        
+        for key in DUBLIN_CORE_PROPERTIES.keys():
+
+            page.append("<dt>{0}</dt><dd>{1}</dd>".format(key.capitalize(), DUBLIN_CORE_PROPERTIES[key]))
+
+        page.append("</dl>")
+
+        form = simple.html.Form(action="/items",
+                                method="POST")
+
+        form.add_fieldset("Item")
+
+        for key in DUBLIN_CORE_PROPERTIES.keys():
+
+            value = ""
+            
+            if key == "date":
+
+                value = datetime.date.today().isoformat()
+
+            if key == "rights":
+
+                value = "CC-BY"
+
+            if key == "format":
+
+                value = "text/plain"
+
+            form.add_input(label = key.capitalize(),
+                           type = "text",
+                           name = key,
+                           value = value)
+
+        page.append(str(form))
+
+        page.append(self.webapp.config["startpage"]["footer"])
+        
+        return str(page)
+
+    add.exposed = True
+
+    def sync(self, token = "0", limit = str(SYNC_LIMIT)):
+        """Return the items added since sync token token as JSON, and a new token.
+           URI: /items/sync?token=...[&limit=N]
+           Responses hold at most limit items and about SYNC_MAX_BYTES
+           bytes; 'more' is true if the client should ask again with
+           the new token right away. An unknown token yields 'reset',
+           and the client has to start over from the beginning.
+        """
+
+        try:
+            limit = max(min(int(limit), SYNC_LIMIT), 1)
+
+        except ValueError:
+
+            raise cherrypy.HTTPError(400, "limit must be a number")
+
+        repository = self.webapp.repository
+
+        since = repository.sync_sequence(token)
+
+        reset = since is None
+
+        if reset:
+
+            since = 0
+
+        changes = repository.changes_since(since, limit)
+
+        # Dicts keep insertion order, and an item added again moves to
+        # the position of its latest change.
+        #
+        item_dicts = {}
+
+        size = 0
+
+        sequence = since
+
+        for sequence_of_change, identifier in changes:
+
+            item_dict = item_as_dict(repository.items[identifier])
+
+            size += len(json.dumps(item_dict))
+
+            if item_dicts and size > SYNC_MAX_BYTES:
+
+                break
+
+            item_dicts.pop(identifier, None)
+
+            item_dicts[identifier] = item_dict
+
+            sequence = sequence_of_change
+
+        items = list(item_dicts.values())
+
+        response = {"items": items,
+                    "token": repository.sync_token(sequence),
+                    "more": sequence < repository.sequence(),
+                    "reset": reset}
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(response, sort_keys=True).encode("utf8")
+
+    sync.exposed = True
+
+    def batch(self, items = None):
+        """Add many items at once, and persist them with a single snapshot.
+           URI: /items/batch
+           Method: POST
+           The request body, or the form field items, is a JSON list of
+           item dicts, or one JSON item dict per line (NDJSON).
+           Identifiers are validated as for single items. Returns JSON
+           with the counts and a per-item result of 'added', 'duplicate'
+           or 'invalid'.
+        """
+
+        request = cherrypy.serving.request
+
+        if request.method != "POST":
+
+            raise cherrypy.HTTPError(405, "Use POST to add items")
+
+        if items is None:
+
+            items = request.body.read().decode("utf8")
+
+        try:
+            if items.lstrip().startswith("["):
+
+                entries = json.loads(items)
+
+            else:
+                entries = [json.loads(line) for line in items.splitlines() if line.strip()]
+
+        except ValueError as error:
+
+            raise cherrypy.HTTPError(400, "Can not parse items as JSON or NDJSON: {0}".format(error))
+
+        if len(entries) > BATCH_LIMIT:
+
+            raise cherrypy.HTTPError(413, "At most {0} items per batch".format(BATCH_LIMIT))
+
+        repository = self.webapp.repository
+
+        response = {"added": 0,
+                    "duplicate": 0,
+                    "invalid": 0,
+                    "results": []}
+
+        for entry in entries:
+
+            identifier = None
+
+            if isinstance(entry, dict):
+
+                identifier = entry.get("identifier")
+
+            if not valid_identifier(identifier):
+
+                result = "invalid"
+
+            elif identifier in repository.items:
+
+                result = "duplicate"
+
+            else:
+                repository.add(item_dict_from(entry))
+
+                result = "added"
+
+            response[result] += 1
+
+            response["results"].append({"identifier": identifier,
+                                        "result": result})
+
+        if response["added"]:
+
+            # Be persistent, once for the whole batch
+            #
+            self.webapp.snapshots.request()
+
+        count_metric("batch_items_added", response["added"])
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(response, sort_keys=True).encode("utf8")
+
+    batch.exposed = True
+
+class WebApp:
+    """Web application main class, suitable as cherrypy root.
+
+       Attributes:
+
+       WebApp.config
+           An instance of configparser.ConfigParser.
+    
+       WebApp.css
+           CSS code to be put in <style></style> section of HTML output.
+
+       WebApp.repository
+           Repository instance.
+
+       WebApp.items
+           ItemsWebApp instance.
+
+       WebApp.derivatives
+           DerivativeCache instance, or None if previews are disabled.
+
+       WebApp.snapshots
+           SnapshotWriter instance persisting WebApp.repository.
+    """
+
+    def __init__(self, config, css = "", repository = None, derivatives = None):
+        """Initialise WebApp.
+           config is an instance of configparser.ConfigParser.
+           css, if given, is CSS code to be put in <style></style> section of HTML output.
+           repository, if given, is used instead of a new Repository instance.
+           derivatives, if given, is a DerivativeCache for item previews.
+        """
+
+        self.config = config
+
+        self.css = css
+
+        self.repository = repository
+
+        self.derivatives = derivatives
+
+        if self.repository is None:
+
+            self.repository = Repository()
+
+        try:
+            self.repository.load()
+            
+        except FileNotFoundError:
+            
+            # File will be created on first edit
+            #
+            pass
+
+        self.snapshots = SnapshotWriter(self.repository)
+
+        # Mount sub-handlers
+        #
+        self.items = ItemsWebApp(self)
+        self.items.exposed = True
+
+        # Make self.__call__ visible to cherrypy
+        #
+        self.exposed = True
+
+        return
+
+    def __call__(self):
+        """Called by cherrypy for the / root page.
+        """
+
+        page = simple.html.Page("TODO: REASONABLE TITLE", css=self.css)
+
+        page.append(self.config["startpage"]["header"])
+
+        page.append("<ul>")
+        page.append('<li><a href="/items">List items</a></li>')
+        page.append('<li><a href="/items/add">Add item</a></li>')
+        page.append("</ul>")
+
+        page.append(self.config["startpage"]["footer"])
+
+        return str(page)
+
+    def changes(self, since = "0", timeout = "0", limit = str(CHANGES_LIMIT)):
+        """Return the change feed as JSON.
+           URI: /changes?since=N[&timeout=seconds][&limit=N]
+           With a timeout, block until there are changes after sequence
+           number since (long-poll), or the timeout has passed.
+        """
+
+        try:
+            since = int(since)
+
+            timeout = min(float(timeout), LONG_POLL_TIMEOUT)
+
+            limit = min(int(limit), CHANGES_LIMIT)
+
+        except ValueError:
+
+            raise cherrypy.HTTPError(400, "since, timeout and limit must be numbers")
+
+        if timeout > 0:
+
+            self.repository.wait_for_changes(since, timeout)
+
+        # Other server processes may have recorded changes whose items
+        # this one can not read yet. 'recorded' tells followers that
+        # such a sequence number is not a reset.
+        #
+        feed = {"sequence": self.repository.sequence(),
+                "recorded": self.repository.recorded(),
+                "changes": []}
+
+        for sequence, identifier in self.repository.changes_since(since, limit):
+
+            feed["changes"].append({"sequence": sequence,
+                                    "identifier": identifier,
+                                    "item": item_as_dict(self.repository.items[identifier])})
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(feed, sort_keys=True).encode("utf8")
+
+    changes.exposed = True
+
+    def replication(self):
+        """Return the replication status of this instance as JSON.
+           URI: /replication
+        """
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(replication_status(), sort_keys=True).encode("utf8")
+
+    replication.exposed = True
+
+    def scrub(self):
+        """Return the report of the integrity scrubber as JSON.
+           URI: /scrub
+        """
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(scrub_report(), sort_keys=True).encode("utf8")
+
+    scrub.exposed = True
+
+    def metrics(self):
+        """Return the counters and gauges of this process as JSON.
+           The results of the scrubber are included from its report, since
+           it may run in another process.
+           URI: /metrics
+        """
+
+        with METRICS_LOCK:
+
+            metrics = dict(METRICS)
+
+        report = scrub_report()
+
+        if report:
+
+            metrics["scrub_corrupt_files"] = len(report.get("corrupt", {}))
+
+            metrics["scrub_verified_files"] = report.get("verified", 0)
+
+            metrics["scrub_passes"] = report.get("passes", 0)
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+
+        return json.dumps(metrics, sort_keys=True).encode("utf8")
+
+    metrics.exposed = True
+
+    def profiler(self, enabled = None, sample = None, threshold = None):
+        """Show the profiler settings and the top functions of recent profiles.
+           URI: /profiler
+           Method: GET, or POST with enabled=0|1, sample=fraction, threshold=seconds
+           Settings can only be changed if [profiler] changeable is set,
+           and only from the local host.
+        """
+
+        if enabled is not None or sample is not None or threshold is not None:
+
+            if not PROFILER.changeable:
+
+                raise cherrypy.HTTPError(403, "Profiler settings can not be changed at runtime, see [profiler] changeable")
+
+            if cherrypy.serving.request.method != "POST":
+
+                raise cherrypy.HTTPError(405, "Profiler settings must be changed with POST")
+
+            if cherrypy.serving.request.remote.ip not in ("127.0.0.1", "::1"):
+
+                raise cherrypy.HTTPError(403, "Profiler settings can only be changed from the local host")
+
+            try:
+                if enabled is not None:
+
+                    PROFILER.enabled = enabled.lower() in ("1", "true", "yes", "on")
+
+                if sample is not None:
+
+                    PROFILER.sample = min(max(float(sample), 0.0), 1.0)
+
+                if threshold is not None:
+
+                    PROFILER.threshold = max(float(threshold), 0.0)
+
+            except ValueError:
+
+                raise cherrypy.HTTPError(400, "sample and threshold must be numbers")
+
+            LOGGER.info("Profiler enabled: {0}, sample: {1}, threshold: {2}".format(PROFILER.enabled, PROFILER.sample, PROFILER.threshold))
+
+        page = simple.html.Page("Profiler", css=self.css)
+
+        page.append(self.config["startpage"]["header"])
+
+        page.append('<ul><li><a href="/">Home</a></li></ul>')
+
+        page.append("<h1>Profiler</h1>")
+
+        page.append("<ul>")
+        page.append("<li>Enabled: {0}</li>".format(PROFILER.enabled))
+        page.append("<li>Sample: {0}</li>".format(PROFILER.sample))
+        page.append("<li>Threshold: {0} s</li>".format(PROFILER.threshold))
+        page.append("<li>Profiles kept: {0} of {1}</li>".format(len(PROFILER.files()), PROFILER.keep))
+        page.append("</ul>")
+
+        page.append("<pre>{0}</pre>".format(html.escape(PROFILER.summary())))
+
+        page.append(self.config["startpage"]["footer"])
+
+        return str(page)
+
+    profiler.exposed = True
+
+    def subpage(self):
+
+        return '<html><head><title>Hello World Subpage</title></head><body><h1>Hello World Subpage</h1><p><a href="/">Go to main page</a></p></body></html>'
+
+    subpage.exposed = True
+
+class AsyncApp:
+    """Serve a WebApp from asyncio, as an ASGI application or through serve_async().
+
+       Page handlers are resolved like the CherryPy default dispatcher
+       does, and run in a thread pool executor, so rendering, hashing
+       and Repository.dump() do not block the event loop. Connections
+       are held by the event loop while reading requests and writing
+       responses, so slow and idle clients do not pin a thread.
+
+       CherryPy tools and sessions are not available in this mode.
+       AdmissionControl is applied directly.
+
+       Attributes:
+
+       AsyncApp.root
+           The WebApp instance to serve.
+
+       AsyncApp.control
+           An AdmissionControl instance, or None.
+
+       AsyncApp.executor
+           The concurrent.futures.ThreadPoolExecutor running page handlers.
+
+       AsyncApp.application
+           A cherrypy.Application for root, so cherrypy.url() and
+           redirects work in page handlers.
+    """
+
+    def __init__(self, root, control = None, threads = THREADS):
+        """Initialise.
+        """
+
+        self.root = root
+
+        self.control = control
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                              thread_name_prefix="AsyncApp")
+
+        self.application = cherrypy.Application(root)
+
+        return
+
+    def resolve(self, path):
+        """Return (handler, args) for the URI path path, or (None, None).
+        """
+
+        node = self.root
+
+        # path is decoded already
+        #
+        segments = [segment for segment in path.strip("/").split("/") if segment]
+
+        while segments:
+
+            child = getattr(node, segments[0], None)
+
+            if child is None or not getattr(child, "exposed", False):
+
+                break
+
+            node = child
+
+            segments.pop(0)
+
+        if not getattr(node, "exposed", False):
+
+            return (None, None)
+
+        return (node, segments)
+
+    def call(self, method, path, kwargs, body = b"", remote = ("", 0), host = ""):
+        """Run the page handler for a request in the current thread.
+           body are the bytes of an unparsed request body, remote is the
+           (address, port) tuple of the client, host the Host header.
+           Return a tuple (status, headers, body bytes).
+        """
+
+        handler, args = self.resolve(path)
+
+        if handler is None:
+
+            return (404, {"Content-Type": "text/plain;charset=utf-8"}, b"Not found\n")
+
+        name = route_class(path, method)
+
+        if self.control is not None and not self.control.acquire(name):
+
+            return (503,
+                    {"Content-Type": "text/plain;charset=utf-8",
+                     "Retry-After": str(self.control.retry_after)},
+                    b"Server busy, please retry.\n")
+
+        # Page handlers may set headers on cherrypy.response. Give them
+        # a fresh one, since thread pool threads are reused.
+        #
+        request = cherrypy._cprequest.Request(cherrypy.lib.httputil.Host("127.0.0.1", 0),
+                                              cherrypy.lib.httputil.Host(remote[0], remote[1]))
+
+        request.method = method
+
+        request.path_info = path
+
+        request.app = self.application
+
+        if host:
+
+            # Base for the Location of redirects
+            #
+            request.base = "http://" + host
+
+        request.body = io.BytesIO(body)
+
+        response = cherrypy._cprequest.Response()
+
+        response.headers["Content-Type"] = "text/html;charset=utf-8"
+
+        cherrypy.serving.load(request, response)
+
+        started = PROFILER.start()
+
+        try:
+            # Check the arguments before calling, so a TypeError raised
+            # inside the handler is not mistaken for a wrong URI
+            #
+            try:
+                inspect.signature(handler).bind(*args, **kwargs)
+
+            except TypeError as error:
+
+                raise cherrypy.HTTPError(404, str(error))
+
+            body = handler(*args, **kwargs)
+
+        except cherrypy.HTTPRedirect as redirect:
+
+            redirect.set_response()
+
+            return (int(str(response.status).split()[0]), dict(response.headers), b"".join(response.body))
+
+        except cherrypy.HTTPError as error:
+
+            return (error.code,
+                    {"Content-Type": "text/plain;charset=utf-8"},
+                    "{0}\n".format(error._message).encode("utf8"))
+
+        except Exception as error:
+
+            LOGGER.error("Handler for {0} {1} failed: {2}".format(method, path, error), exc_info=True)
+
+            return (500, {"Content-Type": "text/plain;charset=utf-8"}, b"Internal server error\n")
+
+        finally:
+            if started is not None:
+
+                PROFILER.finish(started, "{0} {1}".format(method, path))
+
+            if self.control is not None:
+
+                self.control.release(name)
+
+        if isinstance(body, str):
+
+            body = body.encode("utf8")
+
+        status = response.status
+
+        if isinstance(status, str):
+
+            status = int(status.split()[0])
+
+        return (status or 200, dict(response.headers), body)
+
+    async def handle(self, method, path, query, body, content_type = "", remote = ("", 0), host = ""):
+        """Handle one request, running the page handler in the executor.
+           query is an urlencoded string, body are the bytes of the
+           request body. Form bodies are passed to the page handler as
+           keyword arguments, others are available as
+           cherrypy.request.body. remote is the (address, port) tuple
+           of the client, host the Host header.
+           Return a tuple (status, headers, body bytes).
+        """
+
+        kwargs = dict(urllib.parse.parse_qsl(query, keep_blank_values=True))
+
+        if content_type.startswith("application/x-www-form-urlencoded"):
+
+            kwargs.update(urllib.parse.parse_qsl(body.decode("utf8"), keep_blank_values=True))
+
+            body = b""
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.executor, self.call, method, path, kwargs, body, remote, host)
+
+    async def __call__(self, scope, receive, send):
+        """ASGI 3 entry point.
+        """
+
+        if scope["type"] == "lifespan":
+
+            while True:
+
+                message = await receive()
+
+                if message["type"] == "lifespan.startup":
+
+                    await send({"type": "lifespan.startup.complete"})
+
+                elif message["type"] == "lifespan.shutdown":
+
+                    await send({"type": "lifespan.shutdown.complete"})
+
+                    return
+
+        body = b""
+
+        more_body = True
+
+        while more_body:
+
+            message = await receive()
+
+            body += message.get("body", b"")
+
+            more_body = message.get("more_body", False)
+
+        content_type = ""
+
+        host = ""
+
+        for key, value in scope["headers"]:
+
+            if key.lower() == b"content-type":
+
+                content_type = value.decode("latin1").lower()
+
+            elif key.lower() == b"host":
+
+                host = value.decode("latin1")
+
+        status, headers, response_body = await self.handle(scope["method"],
+                                                           scope["path"],
+                                                           scope["query_string"].decode("latin1"),
+                                                           body,
+                                                           content_type,
+                                                           tuple(scope.get("client") or ("", 0)),
+                                                           host)
+
+        await send({"type": "http.response.start",
+                    "status": status,
+                    "headers": [(key.lower().encode("latin1"), str(headers[key]).encode("latin1")) for key in headers.keys()]})
+
+        await send({"type": "http.response.body",
+                    "body": response_body})
+
+        return
+
+    async def read_body(self, reader, headers):
+        """Return the request body announced by the dict headers, read from reader.
+           Chunked bodies are decoded. Raise cherrypy.HTTPError for
+           bodies larger than ASYNC_MAX_BODY_SIZE, and for transfer
+           codings other than chunked.
+        """
+
+        transfer_encoding = headers.get("transfer-encoding", "").lower()
+
+        if transfer_encoding and transfer_encoding != "chunked":
+
+            raise cherrypy.HTTPError(501, "Unsupported transfer coding: '{0}'".format(transfer_encoding))
+
+        if not transfer_encoding:
+
+            length = int(headers.get("content-length", 0))
+
+            if length < 0:
+
+                raise cherrypy.HTTPError(400, "Invalid Content-Length")
+
+            if length > ASYNC_MAX_BODY_SIZE:
+
+                raise cherrypy.HTTPError(413, "Request body too large")
+
+            if not length:
+
+                return b""
+
+            return await reader.readexactly(length)
+
+        chunks = []
+
+        size = 0
+
+        while True:
+
+            size_line = await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)
+
+            # Chunk extensions are ignored
+            #
+            chunk_size = int(size_line.split(b";")[0].strip(), 16)
+
+            if not chunk_size:
+
+                break
+
+            size += chunk_size
+
+            if size > ASYNC_MAX_BODY_SIZE:
+
+                raise cherrypy.HTTPError(413, "Request body too large")
+
+            chunks.append(await reader.readexactly(chunk_size))
+
+            # CRLF after the chunk data
+            #
+            await reader.readexactly(2)
+
+        # Trailer fields are ignored, up to the empty line
+        #
+        while (await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)).strip():
+
+            pass
+
+        return b"".join(chunks)
+
+    async def serve_connection(self, reader, writer):
+        """Serve HTTP/1.1 requests on one connection, with keep-alive.
+        """
+
+        # IPv6 peer names have four fields
+        #
+        remote = tuple((writer.get_extra_info("peername") or ("", 0))[:2])
+
+        try:
+            while True:
+
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)
+
+                except asyncio.TimeoutError:
+
+                    break
+
+                if not request_line.strip():
+
+                    break
+
+                method, target, version = request_line.decode("latin1").split()
+
+                headers = {}
+
+                while True:
+
+                    line = await asyncio.wait_for(reader.readline(), ASYNC_KEEPALIVE_TIMEOUT)
+
+                    if not line.strip():
+
+                        break
+
+                    key, colon, value = line.decode("latin1").partition(":")
+
+                    headers[key.strip().lower()] = value.strip()
+
+                keep_alive = (version == "HTTP/1.1" and headers.get("connection", "").lower() != "close")
+
+                try:
+                    body = await self.read_body(reader, headers)
+
+                except cherrypy.HTTPError as error:
+
+                    # The rest of the body is unread, so the connection
+                    # can not be used for another request
+                    #
+                    body = None
+
+                    keep_alive = False
+
+                    status, response_headers, response_body = (error.code,
+                                                               {"Content-Type": "text/plain;charset=utf-8"},
+                                                               "{0}\n".format(error._message).encode("utf8"))
+
+                if body is not None:
+
+                    path, question_mark, query = target.partition("?")
+
+                    status, response_headers, response_body = await self.handle(method,
+                                                                                urllib.parse.unquote(path),
+                                                                                query,
+                                                                                body,
+                                                                                headers.get("content-type", "").lower(),
+                                                                                remote,
+                                                                                headers.get("host", ""))
+
+                response_headers["Content-Length"] = str(len(response_body))
+
+                response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+
+                head = "HTTP/1.1 {0} {1}\r\n".format(status, http.client.responses.get(status, ""))
+
+                for key in response_headers.keys():
+
+                    head += "{0}: {1}\r\n".format(key, response_headers[key])
+
+                writer.write(head.encode("latin1") + b"\r\n")
+
+                if method != "HEAD":
+
+                    writer.write(response_body)
+
+                await writer.drain()
+
+                if not keep_alive:
+
+                    break
+
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError) as error:
+
+            LOGGER.debug("Closing connection: {0}".format(error))
+
+        finally:
+            writer.close()
+
+        return
+
+def serve_async(root, host, port, control = None, reuse_port = False):
+    """Serve root from an asyncio event loop until interrupted.
+    """
+
+    app = AsyncApp(root, control)
+
+    async def serve():
+
+        server = await asyncio.start_server(app.serve_connection,
+                                            host,
+                                            port,
+                                            backlog=ACCEPTED_QUEUE_SIZE,
+                                            reuse_port=reuse_port)
+
+        LOGGER.info("Serving on http://{0}:{1} with asyncio".format(host, port))
+
+        async with server:
+
+            await server.serve_forever()
+
+        return
+
+    try:
+        asyncio.run(serve())
+
+    except KeyboardInterrupt:
+
+        pass
+
+    finally:
+        app.executor.shutdown(wait=False)
+
+    return
+
+def synthetic_repository(size):
+    """Return a Repository with size generated items, for load tests.
+    """
+
+    repository = Repository()
+
+    for number in range(size):
+
+        identifier = hashlib.sha512("synthetic item {0}".format(number).encode("utf8")).hexdigest()
+
+        repository.add({"identifier": identifier,
+                        "title": "Synthetic item {0}".format(number),
+                        "creator": "load.test{0}@some.domain".format(number % 97),
+                        "date": "{0}-01-01".format(1990 + number % 30),
+                        "format": ["image/svg", "text/plain", "audio/ogg"][number % 3],
+                        "rights": "CC-BY",
+                        "description": "Generated for load testing. " * 4})
+
+    return repository
+
+def serve_synthetic(size, port, admission = True, engine = ENGINE):
+    """Serve a synthetic repository of size items on loopback port port, until terminated.
+       Runs in a temporary directory, so no data of the real repository is touched.
+       engine is "threaded" or "asyncio".
+    """
+
+    os.chdir(tempfile.mkdtemp(prefix="openmediarepository-"))
+
+    config = configparser.ConfigParser()
+
+    config["startpage"] = {"header": "", "footer": ""}
+
+    root = WebApp(config, repository=synthetic_repository(size))
+
+    root.snapshots.start()
+
+    if engine == "asyncio":
+
+        serve_async(root, "127.0.0.1", port, AdmissionControl() if admission else None)
+
+        return
+
+    app_config = {"/": {"tools.admission.on": admission,
+                        "tools.admission.control": AdmissionControl()}}
+
+    cherrypy.config.update({"server.socket_host": "127.0.0.1",
+                            "server.socket_port": port,
+                            "server.thread_pool": THREADS,
+                            "server.socket_queue_size": ACCEPTED_QUEUE_SIZE,
+                            "server.accepted_queue_size": ACCEPTED_QUEUE_SIZE,
+                            "server.accepted_queue_timeout": ACCEPTED_QUEUE_TIMEOUT,
+                            "log.screen": False})
+
+    cherrypy.engine.autoreload.unsubscribe()
+
+    cherrypy.tree.mount(root, "/", config=app_config)
+
+    cherrypy.engine.start()
+
+    cherrypy.engine.block()
+
+    return
+
+def timed_request(uri, data = None):
+    """Request uri, POSTing the dict data if given.
+       Return a tuple (HTTP status or 0 on connection errors, seconds).
+    """
+
+    if data is not None:
+
+        data = urllib.parse.urlencode(data).encode("utf8")
+
+    started = time.monotonic()
+
+    try:
+        with urllib.request.urlopen(uri, data, timeout=60) as response:
+
+            response.read()
+
+            status = response.status
+
+    except urllib.error.HTTPError as error:
+
+        status = error.code
+
+    except OSError:
+
+        status = 0
+
+    return (status, time.monotonic() - started)
+
+def percentile(values, fraction):
+    """Return the value below which fraction of the sorted list values lie.
+    """
+
+    if not values:
+
+        return None
+
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def latency_summary(results):
+    """Summarise a list of (status, seconds) tuples as a dict.
+       Latencies are in milliseconds, over successful requests.
+    """
+
+    latencies = sorted([seconds * 1000 for status, seconds in results if status == 200])
+
+    return {"requests": len(results),
+            "ok": len(latencies),
+            "rejected": len([status for status, seconds in results if status == 503]),
+            "errors": len([status for status, seconds in results if status not in (200, 503)]),
+            "p50": percentile(latencies, 0.5),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99)}
+
+def wait_for_server(uri, timeout = 30):
+    """Block until uri answers, or raise RuntimeError after timeout seconds.
+    """
+
+    deadline = time.monotonic() + timeout
+
+    while timed_request(uri)[0] == 0:
+
+        if time.monotonic() > deadline:
+
+            raise RuntimeError("Server at '{0}' did not come up".format(uri))
+
+        time.sleep(0.1)
+
+    return
+
+def overload_test(size = 2000, clients = 40, duration = 10, port = PORT + 1):
+    """Overload a synthetic server with listing requests, with and without admission control.
+       Most clients request the expensive /items listing, the others
+       request single item pages. Prints p50/p95/p99 latencies per
+       route class as JSON, and returns them as a dict.
+    """
+
+    identifiers = list(synthetic_repository(min(size, 100)).items.keys())
+
+    report = {}
+
+    for admission in (False, True):
+
+        context = multiprocessing.get_context("fork")
+
+        server = context.Process(target=serve_synthetic, args=(size, port, admission))
+
+        server.start()
+
+        base = "http://127.0.0.1:{0}".format(port)
+
+        try:
+            wait_for_server(base + "/metrics")
+
+            results = {"listing": [], "cheap": []}
+
+            deadline = time.monotonic() + duration
+
+            def client(number):
+
+                while time.monotonic() < deadline:
+
+                    if number % 4:
+
+                        results["listing"].append(timed_request(base + "/items"))
+
+                    else:
+                        results["cheap"].append(timed_request("{0}/items/{1}".format(base, identifiers[number % len(identifiers)])))
+
+                return
+
+            threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+
+            for thread in threads:
+
+                thread.start()
+
+            for thread in threads:
+
+                thread.join()
+
+        finally:
+            server.terminate()
+
+            server.join()
+
+        report["admission" if admission else "no_admission"] = dict([(name, latency_summary(results[name])) for name in results.keys()])
+
+    print(json.dumps(report, sort_keys=True, indent=4))
+
+    return report
+
+def serve_instance(port, processes = 1, leader = ""):
+    """Serve an empty repository on port port from a temporary directory, until terminated.
+       processes and leader go to the [server] and [replication]
+       sections of its configuration. The process starts a new process
+       group, so pre-forked workers can be terminated along with it.
+    """
+
+    os.setpgrp()
+
+    os.chdir(tempfile.mkdtemp(prefix="openmediarepository-"))
+
+    config = configparser.ConfigParser()
+
+    config["startpage"] = {"header": "", "footer": ""}
+
+    config["server"] = {"port": str(port),
+                        "processes": str(processes)}
+
+    config["replication"] = {"leader": leader}
+
+    with open("openmediarepository.ini", "wt", encoding="utf8") as fp:
+
+        config.write(fp)
+
+    main(["serve"])
+
+    return
+
+def fetch_changes(base):
+    """Return the list of all identifiers in the change feed of the instance at base, in order.
+    """
+
+    identifiers = []
+
+    while True:
+
+        uri = "{0}/changes?{1}".format(base, urllib.parse.urlencode({"since": len(identifiers)}))
+
+        with urllib.request.urlopen(uri, timeout=60) as response:
+
+            feed = json.loads(response.read().decode("utf8"))
+
+        if not feed["changes"]:
+
+            return identifiers
+
+        identifiers.extend([change["identifier"] for change in feed["changes"]])
+
+def replication_test(size = 300, clients = 8, timeout = 60, port = PORT + 1):
+    """Replicate between two instances on loopback, and check that nothing is lost or reordered.
+       The leader runs two pre-forked server processes, the follower
+       one. clients threads add size items to the leader, half of them
+       one by one and half in batches. Then the change feeds of leader
+       and follower must list all items in the same order, and every
+       read of the leader feed must agree with the others.
+       Prints a report as JSON and returns it as a dict. Raises
+       RuntimeError if the check fails.
+    """
+
+    context = multiprocessing.get_context("fork")
+
+    leader_base = "http://127.0.0.1:{0}".format(port)
+
+    follower_base = "http://127.0.0.1:{0}".format(port + 1)
+
+    instances = [context.Process(target=serve_instance, args=(port, 2)),
+                 context.Process(target=serve_instance, args=(port + 1, 1, leader_base))]
+
+    for instance in instances:
+
+        instance.start()
+
+    started = time.monotonic()
+
+    try:
+        wait_for_server(leader_base + "/metrics")
+
+        wait_for_server(follower_base + "/metrics")
+
+        def submit(request):
+
+            # Admission control sheds writes beyond its queue
+            #
+            while True:
+
+                try:
+                    with urllib.request.urlopen(request, timeout=60) as response:
+
+                        response.read()
+
+                    return
+
+                except urllib.error.HTTPError as error:
+
+                    if error.code != 503:
+
+                        raise
+
+                    time.sleep(float(error.headers.get("Retry-After", 1)))
+
+        def client(number):
+
+            identifiers = [hashlib.sha512("replicated item {0}".format(item_number).encode("utf8")).hexdigest()
+                           for item_number in range(number, size, clients)]
+
+            if number % 2:
+
+                for identifier in identifiers:
+
+                    submit(urllib.request.Request(leader_base + "/items",
+                                                  urllib.parse.urlencode({"identifier": identifier,
+                                                                          "title": "Replicated"}).encode("utf8")))
+
+            else:
+                for start in range(0, len(identifiers), 10):
+
+                    body = json.dumps([{"identifier": identifier, "title": "Replicated"}
+                                       for identifier in identifiers[start:start + 10]]).encode("utf8")
+
+                    submit(urllib.request.Request(leader_base + "/items/batch",
+                                                  body,
+                                                  {"Content-Type": "application/json"}))
+
+            return
+
+        threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+
+        for thread in threads:
+
+            thread.start()
+
+        for thread in threads:
+
+            thread.join()
+
+        deadline = time.monotonic() + timeout
+
+        leader_changes = fetch_changes(leader_base)
+
+        follower_changes = fetch_changes(follower_base)
+
+        while (len(leader_changes) < size or follower_changes != leader_changes) and time.monotonic() < deadline:
+
+            time.sleep(0.5)
+
+            leader_changes = fetch_changes(leader_base)
+
+            follower_changes = fetch_changes(follower_base)
+
+        # Reads are spread over both leader processes
+        #
+        consistent = True
+
+        for attempt in range(10):
+
+            changes = fetch_changes(leader_base)
+
+            consistent = consistent and changes[:len(leader_changes)] == leader_changes[:len(changes)]
+
+    finally:
+        for instance in instances:
+
+            os.killpg(instance.pid, signal.SIGTERM)
+
+        for instance in instances:
+
+            instance.join()
+
+    report = {"items": size,
+              "leader_changes": len(leader_changes),
+              "follower_changes": len(follower_changes),
+              "same_order": follower_changes == leader_changes,
+              "leader_consistent": consistent,
+              "seconds": round(time.monotonic() - started, 3)}
+
+    print(json.dumps(report, sort_keys=True, indent=4))
+
+    if (len(set(leader_changes)) != size
+        or not report["same_order"]
+        or not report["leader_consistent"]):
+
+        raise RuntimeError("Replication test failed")
+
+    return report
+
+def parse_mix(mix):
+    """Parse a request mix like "/=1,/items=1,/items/<id>=6,POST /items=1" into a dict.
+    """
+
+    weights = {}
+
+    for part in mix.split(","):
+
+        route, equals, weight = part.strip().rpartition("=")
+
+        if route not in LOAD_TEST_MIX.keys():
+
+            raise ValueError("Unknown route in request mix: '{0}'".format(route))
+
+        weights[route] = float(weight)
+
+    return weights
+
+def load_test(size = 1000, mix = LOAD_TEST_MIX, rate = 100, duration = 30, engine = ENGINE, port = PORT + 1, concurrency = LOAD_TEST_CONCURRENCY):
+    """Drive a synthetic server on loopback with a mix of requests at a target rate.
+       mix is a dict mapping routes of LOAD_TEST_MIX to weights. Requests
+       are started on a fixed schedule of rate per second, independent of
+       how fast responses come in, and latencies are measured from the
+       scheduled start, so a stalling server shows up in the percentiles.
+       Return a dict with throughput and p50/p95/p99 latencies in
+       milliseconds, overall and per route.
+    """
+
+    identifiers = list(synthetic_repository(min(size, 1000)).items.keys())
+
+    routes = list(mix.keys())
+
+    weights = [mix[route] for route in routes]
+
+    chooser = random.Random(size)
+
+    context = multiprocessing.get_context("fork")
+
+    server = context.Process(target=serve_synthetic, args=(size, port, False, engine))
+
+    server.start()
+
+    base = "http://127.0.0.1:{0}".format(port)
+
+    results = dict([(route, []) for route in routes])
+
+    def request(route, number, scheduled):
+
+        if route == "/items/<id>":
+
+            status, seconds = timed_request("{0}/items/{1}".format(base, chooser.choice(identifiers)))
+
+        elif route == "POST /items":
+
+            identifier = hashlib.sha512("load test post {0}".format(number).encode("utf8")).hexdigest()
+
+            status, seconds = timed_request(base + "/items", {"identifier": identifier,
+                                                               "title": "Load test post {0}".format(number),
+                                                               "format": "text/plain"})
+
+        else:
+            status, seconds = timed_request(base + route)
+
+        results[route].append((status, time.monotonic() - scheduled))
+
+        return
+
+    try:
+        wait_for_server(base + "/metrics")
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+        started = time.monotonic()
+
+        number = 0
+
+        while number < rate * duration:
+
+            scheduled = started + number / rate
+
+            delay = scheduled - time.monotonic()
+
+            if delay > 0:
+
+                time.sleep(delay)
+
+            executor.submit(request, chooser.choices(routes, weights)[0], number, scheduled)
+
+            number += 1
+
+        executor.shutdown(wait=True)
+
+        elapsed = time.monotonic() - started
+
+    finally:
+        server.terminate()
+
+        server.join()
+
+    report = {"size": size,
+              "engine": engine,
+              "target_rate": rate,
+              "duration": round(elapsed, 3),
+              "routes": {}}
+
+    for route in routes:
+
+        report["routes"][route] = latency_summary(results[route])
+
+        report["routes"][route]["throughput"] = round(report["routes"][route]["ok"] / elapsed, 1)
+
+    report["total"] = latency_summary(sum([results[route] for route in routes], []))
+
+    report["total"]["throughput"] = round(report["total"]["ok"] / elapsed, 1)
+
+    return report
+
+def process_memory(pid):
+    """Return the resident set size of process pid in KiB, or None if unknown.
+    """
+
+    try:
+        with open("/proc/{0}/status".format(pid), "rt") as fp:
+
+            for line in fp.readlines():
 
-                    page.append("<li>{0}: {1}</li>".format(dc_key.capitalize(), self.webapp.repository.items[args[0]].__getattr__(dc_key)))
+                if line.startswith("VmRSS:"):
 
-            page.append("</ul>")
+                    return int(line.split()[1])
 
-            page.append(self.webapp.config["startpage"]["footer"])
-            
-            return str(page)
+    except FileNotFoundError:
 
-        # No args.
+        # Not on Linux
 
-        page = simple.html.Page("Items", css=self.webapp.css)
+        pass
 
-        page.append(self.webapp.config["startpage"]["header"])
+    return None
 
-        if len(kwargs):
+def engine_benchmark(size = 1000, clients = 10, slow_clients = 200, duration = 10, port = PORT + 1):
+    """Compare the threaded and asyncio serving engines with slow clients attached.
+       slow_clients connections send an incomplete request and then
+       stay idle, while clients request item pages as fast as they can.
+       Prints latencies and server memory per engine as JSON, and
+       returns them as a dict.
+    """
 
-            if (not "identifier" in kwargs.keys()
-                or not len(kwargs["identifier"])
-                or not kwargs["identifier"].isalnum()):
+    identifiers = list(synthetic_repository(min(size, 100)).items.keys())
 
-                # TODO: Return error code
-                #
-                page.append("<p>Error: invalid identifier</p>")
+    report = {}
 
-                page.append(self.webapp.config["startpage"]["footer"])
-                
-                return str(page)
+    for engine in ("threaded", "asyncio"):
 
-            if kwargs["identifier"] in self.webapp.repository.items.keys():
+        context = multiprocessing.get_context("fork")
 
-                # TODO: Return error code
-                #
-                page.append("<p>Error: identifier already exists</p>")
+        server = context.Process(target=serve_synthetic, args=(size, port, False, engine))
 
-                page.append(self.webapp.config["startpage"]["footer"])
-                
-                return str(page)
+        server.start()
 
-            item_dict = {"identifier": kwargs["identifier"]}
+        base = "http://127.0.0.1:{0}".format(port)
 
-            for key in kwargs.keys():
+        connections = []
 
-                if key != "identifier" and key in DUBLIN_CORE_PROPERTIES.keys():
+        try:
+            wait_for_server(base + "/metrics")
 
-                    item_dict[key] = kwargs[key]
+            memory_before = process_memory(server.pid)
 
-            self.webapp.repository.add(item_dict)
+            for number in range(slow_clients):
 
-            # Be persistent
-            #
-            self.webapp.repository.dump()
+                connection = socket.create_connection(("127.0.0.1", port))
 
-            page.append("<h1>Item added</h1>")
+                connection.sendall(b"GET /items HTTP/1.1\r\nHost: 127.0.0.1\r\n")
 
-            page.append('<p><a href="/items/{0}">View item</a></p>'.format(kwargs["identifier"]))
+                connections.append(connection)
 
-            page.append(self.webapp.config["startpage"]["footer"])
-            
-            return str(page)
+            results = []
 
-        # No kwargs either.
+            deadline = time.monotonic() + duration
 
-        page.append('<ul><li><a href="/">Home</a></li></ul>')
-        
-        page.append("<h1>Items</h1>")
+            def client(number):
 
-        page.append("<ul>")
-        
-        for identifier in self.webapp.repository.items.keys():
+                while time.monotonic() < deadline:
 
-            page.append('<li><a href="/items/{0}">{1}</a>'.format(identifier, self.webapp.repository.items[identifier].title))
+                    results.append(timed_request("{0}/items/{1}".format(base, identifiers[number % len(identifiers)])))
 
-            page.append("<ul>")
-            
-            for dc_key in DUBLIN_CORE_PROPERTIES.keys():
+                return
 
-                if dc_key != "title":
+            threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
 
-                    page.append("<li>{0}: {1}</li>".format(dc_key.capitalize(), self.webapp.repository.items[identifier].__getattr__(dc_key)))
+            for thread in threads:
 
-            page.append("</ul>")        
+                thread.start()
 
-            page.append("</li>")
+            for thread in threads:
 
-        page.append("</ul>")
+                thread.join()
 
-        page.append(self.webapp.config["startpage"]["footer"])
-        
-        return str(page)
+            memory = process_memory(server.pid)
 
-    def add(self):
+        finally:
+            for connection in connections:
 
-        page = simple.html.Page("Add Item", css=self.webapp.css)
+                connection.close()
 
-        page.append(self.webapp.config["startpage"]["header"])
+            server.terminate()
 
-        page.append('<ul><li><a href="/">Home</a></li></ul>')
-        
-        page.append("<h1>Add item</h1>")
+            server.join()
 
-        page.append("<dl>")
-        
-        for key in DUBLIN_CORE_PROPERTIES.keys():
+        report[engine] = latency_summary(results)
 
-            page.append("<dt>{0}</dt><dd>{1}</dd>".format(key.capitalize(), DUBLIN_CORE_PROPERTIES[key]))
+        report[engine]["requests_per_second"] = round(len(results) / duration, 1)
 
-        page.append("</dl>")
+        report[engine]["memory_kib"] = memory
 
-        form = simple.html.Form(action="/items",
-                                method="POST")
+        report[engine]["memory_kib_before_slow_clients"] = memory_before
 
-        form.add_fieldset("Item")
+    print(json.dumps(report, sort_keys=True, indent=4))
 
-        for key in DUBLIN_CORE_PROPERTIES.keys():
+    return report
 
-            value = ""
-            
-            if key == "date":
+def serve_worker(config, css, config_dict, lock, generation, snapshot_lock, engine = ENGINE):
+    """Run one pre-forked server process.
+       The process binds the shared port with SO_REUSEPORT, and the
+       kernel distributes incoming connections between the processes.
+       engine is "threaded" or "asyncio".
+    """
 
-                value = datetime.date.today().isoformat()
+    root = WebApp(config, css, SharedRepository(lock, generation, snapshot_lock), derivative_cache(config))
 
-            if key == "rights":
+    if engine == "asyncio":
 
-                value = "CC-BY"
+        root.snapshots.start()
 
-            if key == "format":
+        serve_async(root,
+                    config_dict["global"]["server.socket_host"],
+                    config_dict["global"]["server.socket_port"],
+                    config_dict["/"].get("tools.admission.control"),
+                    reuse_port=True)
 
-                value = "text/plain"
+        root.snapshots.stop()
 
-            form.add_input(label = key.capitalize(),
-                           type = "text",
-                           name = key,
-                           value = value)
+        if root.derivatives is not None:
 
-        page.append(str(form))
+            root.derivatives.stop()
 
-        page.append(self.webapp.config["startpage"]["footer"])
-        
-        return str(page)
+        return
 
-    add.exposed = True
+    cherrypy.config.update(config_dict["global"])
 
-class WebApp:
-    """Web application main class, suitable as cherrypy root.
+    # The autoreloader would restart a single worker, not the group.
+    #
+    cherrypy.engine.autoreload.unsubscribe()
 
-       Attributes:
+    app_config = dict([(path, config_dict[path]) for path in config_dict.keys() if path != "global"])
 
-       WebApp.config
-           An instance of configparser.ConfigParser.
-    
-       WebApp.css
-           CSS code to be put in <style></style> section of HTML output.
+    cherrypy.tree.mount(root, "/", config=app_config)
 
-       WebApp.repository
-           Repository instance.
+    bind_addr = (config_dict["global"]["server.socket_host"],
+                 config_dict["global"]["server.socket_port"])
 
-       WebApp.items
-           ItemsWebApp instance.
-    """
+    cherrypy.server.unsubscribe()
 
-    def __init__(self, config, css = ""):
-        """Initialise WebApp.
-           config is an instance of configparser.ConfigParser.
-           css, if given, is CSS code to be put in <style></style> section of HTML output.
-        """
+    server = cheroot.wsgi.Server(bind_addr,
+                                 cherrypy.tree,
+                                 numthreads=config_dict["global"]["server.thread_pool"],
+                                 request_queue_size=config_dict["global"]["server.socket_queue_size"],
+                                 accepted_queue_size=config_dict["global"]["server.accepted_queue_size"],
+                                 accepted_queue_timeout=config_dict["global"]["server.accepted_queue_timeout"],
+                                 reuse_port=True)
 
-        self.config = config
+    # ServerAdapter would wait for the port to be free, which it never
+    # is while the other processes are serving. Start the server directly.
+    #
+    def start_server():
 
-        self.css = css
+        server.prepare()
 
-        self.repository = Repository()
+        threading.Thread(target=server.serve, name="HTTPServer", daemon=True).start()
 
-        try:
-            self.repository.load()
-            
-        except FileNotFoundError:
-            
-            # File will be created on first edit
-            #
-            pass
+        return
 
-        # Mount sub-handlers
-        #
-        self.items = ItemsWebApp(self)
-        self.items.exposed = True
+    cherrypy.engine.subscribe("start", start_server)
 
-        # Make self.__call__ visible to cherrypy
+    cherrypy.engine.subscribe("stop", server.stop)
+
+    cherrypy.engine.subscribe("start", root.snapshots.start)
+
+    cherrypy.engine.subscribe("stop", root.snapshots.stop)
+
+    if root.derivatives is not None:
+
+        cherrypy.engine.subscribe("stop", root.derivatives.stop)
+
+    cherrypy.engine.signals.subscribe()
+
+    cherrypy.engine.start()
+
+    cherrypy.engine.block()
+
+    return
+
+def serve_prefork(config, css, config_dict, processes, leader = "", engine = ENGINE):
+    """Serve from several processes sharing one port and one repository snapshot.
+       repository.json remains the authoritative storage; a snapshot is
+       written from it before the processes are started.
+       If leader is given, this process follows it, and the server
+       processes pick up the replicated items like any other commit.
+       The scrubber, if enabled, runs in this process as well, and the
+       server processes serve its results from SCRUB_STATE_PATH.
+    """
+
+    repository = Repository()
+
+    try:
+        repository.load()
+
+    except FileNotFoundError:
+
+        # File will be created on first edit
         #
-        self.exposed = True
+        pass
 
-        return
+    # From here on, changes.txt is only appended to. Record every item
+    # in it, and drop changes without an item, before the numbering
+    # is shared.
+    #
+    repository.dump()
 
-    def __call__(self):
-        """Called by cherrypy for the / root page.
-        """
+    write_snapshot(repository.items, SNAPSHOT_PATH, repository.facets)
 
-        page = simple.html.Page("TODO: REASONABLE TITLE", css=self.css)
+    del repository
 
-        page.append(self.config["startpage"]["header"])
+    context = multiprocessing.get_context("fork")
 
-        page.append("<ul>")
-        page.append('<li><a href="/items">List items</a></li>')
-        page.append('<li><a href="/items/add">Add item</a></li>')
-        page.append("</ul>")
+    lock = context.Lock()
 
-        page.append(self.config["startpage"]["footer"])
+    generation = context.Value("Q", 0, lock=False)
 
-        return str(page)
+    snapshot_lock = context.Lock()
 
-    def subpage(self):
+    workers = []
 
-        return '<html><head><title>Hello World Subpage</title></head><body><h1>Hello World Subpage</h1><p><a href="/">Go to main page</a></p></body></html>'
+    for number in range(processes):
 
-    subpage.exposed = True
+        worker = context.Process(target=serve_worker,
+                                 args=(config, css, config_dict, lock, generation, snapshot_lock, engine),
+                                 name="OpenMediaRepository worker {0}".format(number))
+
+        worker.start()
+
+        workers.append(worker)
+
+    LOGGER.info("Started {0} server processes on port {1}".format(processes, config_dict["global"]["server.socket_port"]))
+
+    if leader:
+
+        Follower(leader, SharedRepository(lock, generation, snapshot_lock)).start()
+
+    if config.getboolean("scrubber", "enabled", fallback=False):
+
+        Scrubber(media_store(config), config.getint("scrubber", "rate", fallback=SCRUB_RATE)).start()
+
+    try:
+        for worker in workers:
+
+            worker.join()
+
+    except KeyboardInterrupt:
+
+        for worker in workers:
+
+            worker.terminate()
+
+        for worker in workers:
+
+            worker.join()
+
+    return
 
-def main():
+def main(argv = None):
     """Main function, for IDE convenience.
+       argv is a list of command line arguments, default sys.argv[1:].
+       Without a command, the repository in CWD is served.
     """
 
+    parser = argparse.ArgumentParser(prog="openmediarepository",
+                                     description="A web based open media repository.")
+
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("serve", help="serve the repository in the current directory (default)")
+
+    loadtest_parser = subparsers.add_parser("loadtest",
+                                            help="drive a synthetic repository on loopback, and report latencies as JSON")
+
+    loadtest_parser.add_argument("--size", type=int, default=1000, help="number of items in the synthetic repository")
+
+    loadtest_parser.add_argument("--rate", type=float, default=100, help="requests per second")
+
+    loadtest_parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+
+    loadtest_parser.add_argument("--mix",
+                                 default=",".join(["{0}={1}".format(route, LOAD_TEST_MIX[route]) for route in LOAD_TEST_MIX.keys()]),
+                                 help="comma separated route=weight pairs, routes: {0}".format(", ".join(LOAD_TEST_MIX.keys())))
+
+    loadtest_parser.add_argument("--engine", choices=["threaded", "asyncio"], default=ENGINE)
+
+    loadtest_parser.add_argument("--port", type=int, default=PORT + 1)
+
+    export_parser = subparsers.add_parser("export",
+                                          help="write the items, accounts and stored media in the current directory to a tar archive")
+
+    export_parser.add_argument("archive", help="archive path, '-' for standard output, compressed if ending in .gz or .tgz")
+
+    import_parser = subparsers.add_parser("import",
+                                          help="add the items, accounts and stored media of a tar archive to the current directory, skipping those present; run again to resume")
+
+    import_parser.add_argument("archive", help="archive path, '-' for standard input")
+
+    import_parser.add_argument("--workers", type=int, default=None, help="threads verifying media, default one per CPU")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "loadtest":
+
+        report = load_test(args.size, parse_mix(args.mix), args.rate, args.duration, args.engine, args.port)
+
+        print(json.dumps(report, sort_keys=True, indent=4))
+
+        return
+
     config = configparser.ConfigParser()
 
     try:
@@ -859,6 +6383,51 @@ def main():
 
             config.write(fp)
 
+    if args.command in ("export", "import"):
+
+        repository = Repository()
+
+        try:
+            repository.load()
+
+        except FileNotFoundError:
+
+            # File will be created on import
+            #
+            pass
+
+        if args.command == "export":
+
+            compression = ""
+
+            if args.archive.endswith((".gz", ".tgz")):
+
+                compression = "gz"
+
+            if args.archive == "-":
+
+                export_archive(sys.stdout.buffer, repository, media_store(config), compression)
+
+            else:
+                with open(args.archive, "wb") as fp:
+
+                    export_archive(fp, repository, media_store(config), compression)
+
+            return
+
+        if args.archive == "-":
+
+            report = import_archive(sys.stdin.buffer, repository, media_store(config), args.workers)
+
+        else:
+            with open(args.archive, "rb") as fp:
+
+                report = import_archive(fp, repository, media_store(config), args.workers)
+
+        print(json.dumps(report, sort_keys=True, indent=4))
+
+        return
+
     css = ""
 
     css_files = glob.glob("*.css")
@@ -869,13 +6438,95 @@ def main():
 
             css = fp.read()
 
-    root = WebApp(config, css)
-
-    config_dict = {"/" : {"tools.sessions.on" : True,
-                          "tools.sessions.timeout" : 60},
+    # No session machinery for anonymous reads. Routes that need
+    # sessions are listed in the [sessions] section.
+    #
+    config_dict = {"/" : {},
                    "global" : {"server.socket_host" : "0.0.0.0",
-                               "server.socket_port" : PORT,
-                               "server.thread_pool" : THREADS}}
+                               "server.socket_port" : config.getint("server", "port", fallback=PORT),
+                               "server.thread_pool" : THREADS,
+                               "server.socket_queue_size" : config.getint("admission", "accepted_queue_size", fallback=ACCEPTED_QUEUE_SIZE),
+                               "server.accepted_queue_size" : config.getint("admission", "accepted_queue_size", fallback=ACCEPTED_QUEUE_SIZE),
+                               "server.accepted_queue_timeout" : ACCEPTED_QUEUE_TIMEOUT}}
+
+    config_dict.update(session_routes(config))
+
+    PROFILER.configure(config)
+
+    # Without the tool, a disabled profiler costs nothing per request.
+    # It can only be enabled at runtime if changeable.
+    #
+    if PROFILER.enabled or PROFILER.changeable:
+
+        config_dict["/"]["tools.sampling_profiler.on"] = True
+
+    if config.getboolean("admission", "enabled", fallback=True):
+
+        limits = dict([(name, config.getint("admission", name, fallback=ADMISSION_LIMITS[name])) for name in ADMISSION_LIMITS.keys()])
+
+        queues = dict([(name, config.getint("admission", name + "_queue", fallback=ADMISSION_QUEUES[name])) for name in ADMISSION_QUEUES.keys()])
+
+        config_dict["/"]["tools.admission.on"] = True
+
+        config_dict["/"]["tools.admission.control"] = AdmissionControl(limits,
+                                                                       queues,
+                                                                       config.getfloat("admission", "queue_timeout", fallback=ADMISSION_QUEUE_TIMEOUT),
+                                                                       config.getint("admission", "retry_after", fallback=ADMISSION_RETRY_AFTER))
+
+    processes = config.getint("server", "processes", fallback=PROCESSES)
+
+    engine = config.get("server", "engine", fallback=ENGINE)
+
+    leader = config.get("replication", "leader", fallback="")
+
+    if processes > 1:
+
+        serve_prefork(config, css, config_dict, processes, leader, engine)
+
+        return
+
+    root = WebApp(config, css, derivatives=derivative_cache(config))
+
+    background = [root.snapshots]
+
+    if leader:
+
+        background.append(Follower(leader, root.repository))
+
+    if config.getboolean("scrubber", "enabled", fallback=False):
+
+        background.append(Scrubber(media_store(config), config.getint("scrubber", "rate", fallback=SCRUB_RATE)))
+
+    if engine == "asyncio":
+
+        for task in background:
+
+            task.start()
+
+        serve_async(root,
+                    config_dict["global"]["server.socket_host"],
+                    config_dict["global"]["server.socket_port"],
+                    config_dict["/"].get("tools.admission.control"))
+
+        for task in background:
+
+            task.stop()
+
+        if root.derivatives is not None:
+
+            root.derivatives.stop()
+
+        return
+
+    for task in background:
+
+        cherrypy.engine.subscribe("start", task.start)
+
+        cherrypy.engine.subscribe("stop", task.stop)
+
+    if root.derivatives is not None:
+
+        cherrypy.engine.subscribe("stop", root.derivatives.stop)
 
     # Conditionally turn off Autoreloader
     #